@@ -32,18 +32,38 @@ App包里的Assets.car里导出的图片必须先用pngcruch进行反处理
 """
 
 
+import hashlib
 import imghdr
+import io
 import os
 import sys
 import json
 import shutil
 import getopt
+import time
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 
 from PIL import Image
 
+from pipeline_trace import stage, count, enable_from_env
+
 
 NEED_HANDLE_IMAGE_TYPES = ("png", "jpeg")
+IMAGE_SCALES = (1, 2, 3)
+# 图片组中可以用 Pillow 处理的图片, pdf/svg/heic 等矢量或其他格式的图片不处理
+RENDITION_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# Pillow 解码损坏的图片时抛出的异常, png 数据块错误时为 SyntaxError
+IMAGE_ERRORS = (OSError, SyntaxError)
+# 缩小前需要转换的图片模式
+SCALE_MODES = {"1": "L", "I;16": "I", "I;16L": "I", "I;16B": "I", "I;16N": "I"}
+# 感知哈希(dHash)的尺寸, 9x8 灰度图相邻像素比较得到 64 位
+DHASH_SIZE = 8
+DUPLICATE_REPORT_NAME = "Assets.duplicates.json"
+OPTIMIZE_REPORT_NAME = "Assets.optimize.json"
+# 无损压缩时尝试的 zlib 等级和策略
+PNG_COMPRESS_LEVELS = (6, 9)
+PNG_COMPRESS_STRATEGIES = (Image.DEFAULT_STRATEGY, Image.FILTERED, Image.RLE)
 EMPTY_CONTENT_JSON = {"images": [], "info": {"version": 1, "author": "xcode"}}
 APP_ICON_SET_INFO = (
     (20, 2, "iphone"),
@@ -103,51 +123,47 @@ def convert_optimized_pngs(file_path):
     pngcrush_file = get_executable_file_path_in_current_dir("pngcrush")
     cmd_options = ' -revert-iphone-optimizations -q '
     cammand_line = pngcrush_file + cmd_options + ' "'+file_path+'"  "'+tmp_png_path+'" \n'
-    os.system(cammand_line)
-    os.remove(file_path)
-    os.rename(tmp_png_path, file_path)
+    with stage("pngcrush_revert"):
+        os.system(cammand_line)
+        os.remove(file_path)
+        os.rename(tmp_png_path, file_path)
 
 
-def check_app_icon(source_image_path):
+def check_app_icon(source_image_path, interactive=True):
     """
     检查图标源文件是否符合要求
     :param source_image_path: 图标源文件
+    :param interactive: 长宽不同时是否询问, 不询问时直接失败
     :return: 检查结果
     """
-    if not need_to_handle(source_image_path):
-        print("图标必须是个图片!")
-        return False
-    img_w, img_h = Image.open(source_image_path).size
-    if img_w != img_h:
-        usr_input = input("图片长宽高不同,可能影响显示效果,仍要使用请输入'y'\n")
+    problem = app_icon_problem(source_image_path)
+    if problem is None:
+        return True
+    message, confirmable = problem
+    if confirmable and interactive:
+        usr_input = input(message + ",仍要使用请输入'y'\n")
         return usr_input == 'y'
-    if img_h < 1024:
-        print("图片尺寸小于1024相素,可能影响显示效果,仍要使用请输入'y'\n")
-        return False
-    return True
+    print(message)
+    return False
 
 
-def write_icon_info(size, scale, idiom, filename):
+def app_icon_problem(source_image_path, im=None):
     """
-    添加单个图标信息到图片组Contents.json
-    :param size: 图标点尺寸
-    :param scale: 缩放比例
-    :param idiom: 对应
-    :param filename: 对应的文件名
-    :return:
+    图标源文件的问题, 不做任何交互
+    :param source_image_path: 图标源文件
+    :param im: 已经打开的图片, 避免重复解码
+    :return: None 表示没有问题, 否则为 (提示, 是否可以确认后继续使用)
     """
-    try:
-        info = json.load(open("Contents.json"))
-    except FileNotFoundError:
-        info = deepcopy(EMPTY_CONTENT_JSON)
-    add_icon = {
-        "size": "x".join((size, size)),
-        "scale": scale,
-        "idiom": idiom,
-        "filename": filename
-    }
-    info["images"].append(add_icon)
-    json.dump(info, open("Contents.json", "w"))
+    if im is None:
+        if not need_to_handle(source_image_path):
+            return "图标必须是个图片!", False
+        im = Image.open(source_image_path)
+    img_w, img_h = im.size
+    if img_w != img_h:
+        return "图片长宽高不同,可能影响显示效果", True
+    if img_h < 1024:
+        return "图片尺寸小于1024相素,可能影响显示效果", False
+    return None
 
 
 def clear_dir(icon_dir):
@@ -163,35 +179,236 @@ def clear_dir(icon_dir):
         os.mkdir(icon_dir)
 
 
-def process_app_icon_asset(source_image_path, dst_dir, icon_asset_name="AppIcon"):
+def app_icon_file_name(icon_asset_name, info):
+    """
+    图标文件名和Contents.json中的信息
+    :param icon_asset_name: 图标组名
+    :param info: APP_ICON_SET_INFO 中的一项
+    :return: 文件名, 像素尺寸, Contents.json 中的一项
+    """
+    size, scale, idiom = str(info[0]), str(info[1]) + "x", info[2]
+    image_name = icon_asset_name + size + idiom + "@" + scale + ".png"
+    icon_info = {
+        "size": "x".join((size, size)),
+        "scale": scale,
+        "idiom": idiom,
+        "filename": image_name
+    }
+    return image_name, int(round(info[0] * info[1])), icon_info
+
+
+def render_app_icons(im):
+    """
+    按 APP_ICON_SET_INFO 中不同的像素尺寸各生成一次 png, 例如 40@2x 和 80@1x 共用同一张
+    :param im: 已经解码的图标源文件
+    :return: {像素尺寸: png 数据}
+    """
+    if im.size[0] != im.size[1]:
+        im = im.resize((1024, 1024), Image.LANCZOS)
+    rendered = dict()
+    for info in APP_ICON_SET_INFO:
+        icon_size = int(round(info[0] * info[1]))
+        if icon_size in rendered:
+            continue
+        with stage("icon_render", size=icon_size):
+            icon = im.copy() if icon_size >= max(im.size) else im.resize((icon_size, icon_size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            icon.save(buffer, "png")
+        rendered[icon_size] = buffer.getvalue()
+    return rendered
+
+
+def write_app_icon_set(rendered, dst_dir, icon_asset_name="AppIcon"):
+    """
+    写入一个图标组, 不改变当前目录
+    :param rendered: render_app_icons 的结果
+    :param dst_dir: Assets 路径
+    :param icon_asset_name: 图标组名
+    :return: 写入的文件名列表
+    """
+    icon_dir = os.path.join(dst_dir, ".".join((icon_asset_name, "appiconset")))
+    clear_dir(icon_dir)
+    info = deepcopy(EMPTY_CONTENT_JSON)
+    written = list()
+    for icon in APP_ICON_SET_INFO:
+        image_name, icon_size, icon_info = app_icon_file_name(icon_asset_name, icon)
+        with open(os.path.join(icon_dir, image_name), "wb") as f:
+            f.write(rendered[icon_size])
+        info["images"].append(icon_info)
+        written.append(image_name)
+    with stage("json_write"):
+        json.dump(info, open(os.path.join(icon_dir, "Contents.json"), "w"))
+    return written
+
+
+def process_app_icon_asset(source_image_path, dst_dir, icon_asset_name="AppIcon", interactive=True):
     """
     生成AppIcon.appiconset图标
     :param source_image_path: 图标源文件
     :param dst_dir: 输出目录路径
     :param icon_asset_name: 图标组名,默认为"AppIcon"
-    :return:
+    :param interactive: 图标有问题时是否询问
+    :return: 是否生成了图标组
     """
-    if not check_app_icon(source_image_path):
-        return
+    if not check_app_icon(source_image_path, interactive):
+        return False
 
     # 生成图片组
-    os.chdir(dst_dir)
-    icon_dir = ".".join((icon_asset_name, "appiconset"))
-    clear_dir(icon_dir)
-    os.chdir(icon_dir)
-    for index, info in enumerate(APP_ICON_SET_INFO):
-        size, scale, idiom = str(info[0]), str(info[1])+"x", info[2]
-        image_name = icon_asset_name+size+idiom+"@"+scale+".png"
-        # 生成图片
-        im = Image.open(source_image_path)
-        icon_size = info[0] * info[1]
-        if im.size[0] != im.size[1]:
-            im = im.resize((1024, 1024))
-        im.thumbnail((icon_size, icon_size), Image.ANTIALIAS)
-        im.save(image_name, 'png')
-        # 保存对应信息
-        write_icon_info(size, scale, idiom, image_name)
+    im = Image.open(source_image_path)
+    for image_name in write_app_icon_set(render_app_icons(im), dst_dir, icon_asset_name):
         print("成功添加图标", image_name)
+    return True
+
+
+def load_app_icon_manifest(manifest_path):
+    """
+    读取并检查批量图标清单, 不做任何交互
+    清单是 json 列表, 每项为 {"source": 图标源文件, "catalog": Assets 路径, "name": 图标组名(默认 AppIcon),
+    "force": 长宽不同时仍然使用(可选)}, 相对路径相对清单所在目录
+    :param manifest_path: 清单路径
+    :return: 按源文件分组的任务 [(源文件, force, [(Assets 路径, 图标组名), ...]), ...], 错误列表
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    entries = json.load(open(manifest_path))
+    if not isinstance(entries, list):
+        return [], ["清单必须是列表"]
+    groups = dict()
+    targets = dict()
+    errors = list()
+    for index, entry in enumerate(entries):
+        if not isinstance(entry, dict) or not entry.get("source") or not entry.get("catalog"):
+            errors.append("第 %d 项缺少 source 或 catalog" % index)
+            continue
+        source = os.path.realpath(os.path.join(base_dir, os.path.expanduser(entry["source"])))
+        catalog = os.path.realpath(os.path.join(base_dir, os.path.expanduser(entry["catalog"])))
+        name = entry.get("name") or "AppIcon"
+        if not os.path.isfile(source):
+            errors.append("第 %d 项图标文件不存在: %s" % (index, source))
+            continue
+        if not need_to_handle(source):
+            errors.append("第 %d 项图标必须是个图片: %s" % (index, source))
+            continue
+        if not os.path.isdir(os.path.dirname(catalog)) or (os.path.exists(catalog) and not os.path.isdir(catalog)):
+            errors.append("第 %d 项 Assets 所在目录不存在或不是目录: %s" % (index, catalog))
+            continue
+        target = (catalog, name)
+        if target in targets:
+            errors.append("第 %d 项与第 %d 项输出到同一个图标组: %s" % (index, targets[target], os.path.join(*target)))
+            continue
+        targets[target] = index
+        group = groups.setdefault((source, bool(entry.get("force"))), list())
+        group.append(target)
+    return [(source, force, group) for (source, force), group in groups.items()], errors
+
+
+def render_app_icon_source(source, force):
+    """
+    解码源文件并生成所有尺寸
+    :param source: 图标源文件
+    :param force: 长宽不同时仍然使用
+    :return: {"rendered": render_app_icons 的结果, "error": 错误信息, "decode": 解码耗时, "render": 缩放和编码耗时}
+    """
+    result = {"rendered": None, "error": None, "decode": 0.0, "render": 0.0}
+    start = time.perf_counter()
+    try:
+        im = Image.open(source)
+        im.load()
+    except IMAGE_ERRORS as e:
+        result["error"] = "无法解码: %s" % e
+        return result
+    result["decode"] = time.perf_counter() - start
+    problem = app_icon_problem(source, im)
+    if problem is not None and not (problem[1] and force):
+        result["error"] = problem[0]
+        return result
+    start = time.perf_counter()
+    try:
+        result["rendered"] = render_app_icons(im)
+    except IMAGE_ERRORS as e:
+        result["error"] = "无法生成图标: %s" % e
+    result["render"] = time.perf_counter() - start
+    return result
+
+
+def render_app_icon_group(task, cache=None):
+    """
+    解码一次源文件, 生成所有尺寸后写入使用它的每个图标组, 在进程池中运行
+    每个图标组单独处理写入错误, 一个图标组失败不影响其他图标组
+    :param task: load_app_icon_manifest 返回的一项
+    :param cache: 可选的缓存, cache((源文件, force), create) 返回缓存的 render_app_icon_source 结果,
+        没有时调用 create() 生成, 与 job_server.LruCache.get 相同
+    :return: 统计 {"source", "icon_sets", "rendered", "written", "failed", "cached", "decode", "render", "write",
+        "error", "target_errors"}
+    """
+    source, force, targets = task
+    result = {"source": source, "icon_sets": 0, "rendered": 0, "written": 0, "failed": 0, "cached": False,
+              "decode": 0.0, "render": 0.0, "write": 0.0, "error": None, "target_errors": []}
+    created = list()
+
+    def create():
+        created.append(True)
+        return render_app_icon_source(source, force)
+
+    rendered = create() if cache is None else cache((source, force), create)
+    result["cached"] = not created
+    if created:
+        result["decode"] = rendered["decode"]
+        result["render"] = rendered["render"]
+    if rendered["error"]:
+        result["error"] = rendered["error"]
+        result["failed"] = len(targets)
+        return result
+    result["rendered"] = len(rendered["rendered"])
+    start = time.perf_counter()
+    for catalog, name in targets:
+        try:
+            os.makedirs(catalog, exist_ok=True)
+            result["written"] += len(write_app_icon_set(rendered["rendered"], catalog, name))
+        except OSError as e:
+            result["target_errors"].append("%s: %s" % (os.path.join(catalog, name + ".appiconset"), e))
+            result["failed"] += 1
+            continue
+        result["icon_sets"] += 1
+    result["write"] = time.perf_counter() - start
+    return result
+
+
+def process_app_icon_manifest(manifest_path, max_workers=None):
+    """
+    按清单批量生成图标组, 相同的源文件只解码一次, 不同源文件在进程池中并行处理
+    :param manifest_path: 清单路径, 格式见 load_app_icon_manifest
+    :param max_workers: 进程数, 默认为 CPU 核数
+    :return: 汇总 {"icon_sets", "sources", "rendered", "written", "failed", "seconds", "results"}
+    """
+    start = time.perf_counter()
+    tasks, errors = load_app_icon_manifest(manifest_path)
+    for error in errors:
+        print(error)
+    print("正在生成", sum(len(task[2]) for task in tasks), "个图标组,", len(tasks), "个源文件,请等待....")
+    results = list()
+    with stage("icon_batch", sources=len(tasks)), ProcessPoolExecutor(max_workers) as pool:
+        for result in pool.map(render_app_icon_group, tasks):
+            if result["error"]:
+                print("%s: %s" % (result["source"], result["error"]))
+            for error in result["target_errors"]:
+                print(error)
+            count("icons_written", result["written"])
+            results.append(result)
+    summary = {
+        "icon_sets": sum(result["icon_sets"] for result in results),
+        "sources": len(results),
+        "rendered": sum(result["rendered"] for result in results),
+        "written": sum(result["written"] for result in results),
+        "failed": len(errors) + sum(result["failed"] for result in results),
+        "seconds": time.perf_counter() - start,
+        "results": results,
+    }
+    print("图标组: %d 个, 源文件: %d 个, 生成图片: %d 张, 写入文件: %d 个, 失败: %d 项" % (
+        summary["icon_sets"], summary["sources"], summary["rendered"], summary["written"], summary["failed"]))
+    print("耗时: 总共 %.2fs, 解码 %.2fs, 缩放和编码 %.2fs, 写入 %.2fs (后三项为各进程累计)" % (
+        summary["seconds"], sum(result["decode"] for result in results),
+        sum(result["render"] for result in results), sum(result["write"] for result in results)))
+    return summary
 
 
 def generate_assets_dir(dst_dir):
@@ -260,9 +477,12 @@ def add_single_image_to_assets(image_path, dst_dir):
             return
     images_info.append(single_image_info)
     added_img = os.path.join(image_set_path, image_file)
-    shutil.copy(image_path, added_img)
+    with stage("copy"):
+        shutil.copy(image_path, added_img)
+    count("images_added")
     convert_optimized_pngs(added_img)
-    json.dump(info, open(json_path, "w"))
+    with stage("json_write"):
+        json.dump(info, open(json_path, "w"))
 
 
 def add_all_dir_images_to_assets(source_image_dir, dst_dir):
@@ -275,11 +495,474 @@ def add_all_dir_images_to_assets(source_image_dir, dst_dir):
     os.chdir(dst_dir)
     for item in os.listdir(source_image_dir):
         abs_path = os.path.join(source_image_dir, item)
-        if os.path.isfile(abs_path) and need_to_handle(abs_path):
+        with stage("classify"):
+            handle = os.path.isfile(abs_path) and need_to_handle(abs_path)
+        if handle:
             add_single_image_to_assets(abs_path, dst_dir)
             print("正在添加图片", abs_path)
 
 
+def iter_image_sets(dst_dir):
+    """
+    遍历 Assets 下所有普通图片组
+    没有倍数的图片(矢量图等单一尺寸图片)和 Pillow 不能处理的格式不返回
+    :param dst_dir: Assets 路径
+    :return: 生成 (图片组路径, {倍数: 文件名})
+    """
+    for item in sorted(os.listdir(dst_dir)):
+        image_set_path = os.path.join(dst_dir, item)
+        if not item.endswith(".imageset") or not os.path.isdir(image_set_path):
+            continue
+        try:
+            info = json.load(open(os.path.join(image_set_path, "Contents.json")))
+        except FileNotFoundError:
+            continue
+        scales = dict()
+        for image_info in info["images"]:
+            file_name = image_info.get("filename")
+            if file_name and image_info.get("scale") and file_name.lower().endswith(RENDITION_EXTENSIONS):
+                scales[int(image_info["scale"].rstrip("x"))] = image_info["filename"]
+        if scales:
+            yield image_set_path, scales
+
+
+def find_missing_renditions(dst_dir):
+    """
+    找出需要补齐低倍图的图片组
+    :param dst_dir: Assets 路径
+    :return: [(图片组路径, 最高倍图文件名, 最高倍数, 缺少的倍数列表), ...]
+    """
+    tasks = list()
+    for image_set_path, scales in iter_image_sets(dst_dir):
+        top_scale = max(scales)
+        missing = [scale for scale in IMAGE_SCALES if scale < top_scale and scale not in scales]
+        if missing:
+            tasks.append((image_set_path, scales[top_scale], top_scale, missing))
+    return tasks
+
+
+def render_missing_renditions(task):
+    """
+    解码一次最高倍图, 缩小生成所有缺少的倍数
+    jpeg 用 draft 在解码时直接缩小, 整数倍缩小用 reduce
+    :param task: find_missing_renditions 返回的一项
+    :return: 图片组路径, [(倍数, 文件名), ...], 解码失败时的错误信息
+    """
+    try:
+        return render_image_set_renditions(*task)
+    except IMAGE_ERRORS as e:
+        return task[0], [], str(e)
+
+
+def render_image_set_renditions(image_set_path, source_file, top_scale, missing):
+    image_set_name = os.path.basename(image_set_path)[:-len(".imageset")]
+    ext = source_file.split(".")[-1]
+    im = Image.open(os.path.join(image_set_path, source_file))
+    image_format = im.format
+    width, height = im.size
+    sizes = {scale: (max(1, round(width * scale / top_scale)), max(1, round(height * scale / top_scale)))
+             for scale in missing}
+    if image_format == "JPEG":
+        im.draft(im.mode, sizes[max(missing)])
+    im.load()
+    # reduce 不支持调色板, 1 位和 16 位图, resize 对调色板和 1 位图会退化为 NEAREST, 先转换为可以插值的模式
+    if im.mode in ("P", "PA"):
+        im = im.convert("RGBA" if im.mode == "PA" or "transparency" in im.info else "RGB")
+    elif im.mode in SCALE_MODES:
+        im = im.convert(SCALE_MODES[im.mode])
+    added = list()
+    for scale in missing:
+        size = sizes[scale]
+        factor = im.size[0] // size[0]
+        if factor > 1 and im.size[0] == size[0] * factor and im.size[1] == size[1] * factor:
+            scaled = im.reduce(factor)
+        else:
+            scaled = im.resize(size, Image.LANCZOS, reducing_gap=2.0)
+        file_name = "{}@{}x.{}".format(image_set_name, scale, ext)
+        if image_format == "JPEG":
+            scaled.save(os.path.join(image_set_path, file_name), "JPEG", quality=95)
+        else:
+            # png 没有 32 位灰度, 按 16 位保存
+            if scaled.mode == "I":
+                scaled = scaled.convert("I;16")
+            scaled.save(os.path.join(image_set_path, file_name), "PNG")
+        added.append((scale, file_name))
+    return image_set_path, added, None
+
+
+def add_rendition_entries(info, added):
+    """
+    把生成的图片写入 Contents.json
+    Xcode 生成的图片组每个倍数都有一项, 没有图片的项没有 filename, 有同倍数的空项时填入文件名, 没有时才新增,
+    idiom 与最高倍图相同
+    :param info: Contents.json 的内容
+    :param added: render_missing_renditions 返回的 [(倍数, 文件名), ...]
+    :return:
+    """
+    images = info["images"]
+    source = max((image_info for image_info in images
+                  if image_info.get("scale") and image_info.get("filename", "").lower().endswith(RENDITION_EXTENSIONS)),
+                 key=lambda image_info: int(image_info["scale"].rstrip("x")))
+    idiom = source.get("idiom", "universal")
+    appended = False
+    for scale, file_name in added:
+        scale_info = str(scale) + "x"
+        for image_info in images:
+            if (image_info.get("scale") == scale_info and not image_info.get("filename")
+                    and image_info.get("idiom", idiom) == idiom):
+                image_info["filename"] = file_name
+                break
+        else:
+            images.append({"idiom": idiom, "filename": file_name, "scale": scale_info})
+            appended = True
+    if appended:
+        images.sort(key=lambda image_info: image_info.get("scale", ""))
+
+
+def complete_image_set_renditions(dst_dir, max_workers=None):
+    """
+    为只有 @3x 或 @2x 的图片组补齐低倍图, 并写入Contents.json
+    :param dst_dir: Assets 路径
+    :param max_workers: 进程数, 默认为 CPU 核数
+    :return: 生成的图片数量
+    """
+    tasks = find_missing_renditions(dst_dir)
+    if not tasks:
+        return 0
+    print("正在为", len(tasks), "个图片组生成缺少的倍图,请等待....")
+    counter = 0
+    with stage("complete_renditions", image_sets=len(tasks)), ProcessPoolExecutor(max_workers) as pool:
+        for image_set_path, added, error in pool.map(render_missing_renditions, tasks, chunksize=16):
+            if error:
+                print("无法解码", image_set_path, error)
+                continue
+            json_path = os.path.join(image_set_path, "Contents.json")
+            info = json.load(open(json_path))
+            add_rendition_entries(info, added)
+            with stage("json_write"):
+                json.dump(info, open(json_path, "w"))
+            counter += len(added)
+    return counter
+
+
+def import_numpy():
+    """
+    按需导入 numpy, 只有查找相似图片时才需要
+    :return: numpy 模块
+    """
+    try:
+        import numpy
+    except ImportError:
+        print("pip3 install numpy")
+        sys.exit()
+    return numpy
+
+
+def hash_image_file(image_path):
+    """
+    计算图片的像素哈希和感知哈希(dHash)
+    像素哈希基于解码后的 RGBA 数据, 文件内容不同但像素相同也能识别
+    :param image_path: 图片路径
+    :return: 图片路径, 像素哈希, 64 位 dHash, 解码失败时的错误信息
+    """
+    np = import_numpy()
+    try:
+        im = Image.open(image_path).convert("RGBA")
+    except IMAGE_ERRORS as e:
+        return image_path, None, None, str(e)
+    pixel_hash = hashlib.sha1(("%dx%d" % im.size).encode() + im.tobytes()).hexdigest()
+    gray = np.asarray(im.convert("L").resize((DHASH_SIZE + 1, DHASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits(gray[:, 1:] > gray[:, :-1])
+    return image_path, pixel_hash, int.from_bytes(bits.tobytes(), "big"), None
+
+
+def hamming_distance(hash1, hash2):
+    return bin(hash1 ^ hash2).count("1")
+
+
+class BKTree:
+    """
+    按汉明距离组织的 BK 树, 查询一定距离内的哈希时不需要两两比较
+    """
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, item):
+        node = [value, item, dict()]
+        if self.root is None:
+            self.root = node
+            return
+        current = self.root
+        while True:
+            distance = hamming_distance(value, current[0])
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def search(self, value, max_distance):
+        """
+        查找距离不超过 max_distance 的所有项
+        :param value: 哈希
+        :param max_distance: 最大汉明距离
+        :return: [(距离, 项), ...]
+        """
+        result = list()
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(value, node[0])
+            if distance <= max_distance:
+                result.append((distance, node[1]))
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return result
+
+
+def find_root(parent, name):
+    """
+    并查集查找, 同时压缩路径
+    :param parent: {名字: 父节点名字}
+    :param name:
+    :return: 根节点名字
+    """
+    while parent[name] != name:
+        parent[name] = parent[parent[name]]
+        name = parent[name]
+    return name
+
+
+def find_duplicate_image_sets(dst_dir, max_distance=None, max_workers=None):
+    """
+    查找内容重复的图片组
+    所有倍图像素都相同的图片组按签名分组, 相似图片组用最高倍图的 dHash 在 BK 树中查找
+    有图片无法解码的图片组不参与查找
+    :param dst_dir: Assets 路径
+    :param max_distance: dHash 最大汉明距离, None 表示只查找完全相同的图片组
+    :param max_workers: 进程数, 默认为 CPU 核数
+    :return: [{"kind": "exact" 或 "similar", "sets": [图片组名, ...]}, ...]
+    """
+    image_sets = list(iter_image_sets(dst_dir))
+    paths = [os.path.join(image_set_path, file_name)
+             for image_set_path, scales in image_sets for file_name in scales.values()]
+    hashes = dict()
+    with stage("dedupe_hash", images=len(paths)), ProcessPoolExecutor(max_workers) as pool:
+        for image_path, pixel_hash, dhash, error in pool.map(hash_image_file, paths, chunksize=32):
+            if error:
+                print("无法解码", image_path, error)
+                continue
+            hashes[image_path] = (pixel_hash, dhash)
+
+    exact_groups = dict()
+    top_dhash = dict()
+    for image_set_path, scales in image_sets:
+        if any(os.path.join(image_set_path, file_name) not in hashes for file_name in scales.values()):
+            continue
+        name = os.path.basename(image_set_path)[:-len(".imageset")]
+        signature = tuple(sorted((scale, hashes[os.path.join(image_set_path, file_name)][0])
+                                 for scale, file_name in scales.items()))
+        exact_groups.setdefault(signature, list()).append(name)
+        top_dhash[name] = hashes[os.path.join(image_set_path, scales[max(scales)])][1]
+
+    clusters = [{"kind": "exact", "sets": names} for names in exact_groups.values() if len(names) > 1]
+    if max_distance is None:
+        return clusters
+
+    # 每组完全相同的图片组只取第一个参与相似查找, 用并查集合并相似的图片组
+    tree = BKTree()
+    parent = dict()
+
+    for names in exact_groups.values():
+        name = names[0]
+        parent[name] = name
+        for _distance, other in tree.search(top_dhash[name], max_distance):
+            parent[find_root(parent, other)] = find_root(parent, name)
+        tree.add(top_dhash[name], name)
+    similar_groups = dict()
+    for names in exact_groups.values():
+        similar_groups.setdefault(find_root(parent, names[0]), list()).append(names)
+    for groups in similar_groups.values():
+        if len(groups) > 1:
+            clusters.append({"kind": "similar", "sets": sorted(name for names in groups for name in names)})
+    return clusters
+
+
+def collapse_duplicate_image_sets(dst_dir, clusters):
+    """
+    每组重复图片只保留第一个图片组, 删除其余图片组
+    完全相同和相似的分组可能重叠, 有共同图片组的分组先合并, 每个合并后的分组只保留名字最小的图片组,
+    保证别名都指向保留下来的图片组
+    Assets 不支持图片组别名, 被删除的名字和保留的名字对应关系返回给调用者写入报告, 代码中按报告替换图片名
+    :param dst_dir: Assets 路径
+    :param clusters: find_duplicate_image_sets 的结果
+    :return: {被删除的图片组名: 保留的图片组名}
+    """
+    parent = dict()
+
+    for cluster in clusters:
+        for name in cluster["sets"]:
+            parent.setdefault(name, name)
+            root, other = sorted((find_root(parent, cluster["sets"][0]), find_root(parent, name)))
+            parent[other] = root
+    aliases = dict()
+    for name in sorted(parent):
+        keep = find_root(parent, name)
+        if name != keep:
+            shutil.rmtree(os.path.join(dst_dir, name + ".imageset"))
+            aliases[name] = keep
+    return aliases
+
+
+def dedupe_image_sets(dst_dir, max_distance=None, collapse=False, max_workers=None):
+    """
+    查找重复的图片组, 输出报告, 可选合并
+    报告保存在 Assets 同级目录的 Assets.duplicates.json
+    :param dst_dir: Assets 路径
+    :param max_distance: dHash 最大汉明距离, None 表示只查找完全相同的图片组
+    :param collapse: 是否合并重复的图片组
+    :param max_workers: 进程数
+    :return: 报告
+    """
+    print("正在查找重复图片,请等待....")
+    clusters = find_duplicate_image_sets(dst_dir, max_distance, max_workers)
+    for cluster in clusters:
+        print("重复图片组(%s):" % cluster["kind"], ", ".join(cluster["sets"]))
+    report = {"clusters": clusters, "aliases": {}}
+    if collapse:
+        report["aliases"] = collapse_duplicate_image_sets(dst_dir, clusters)
+        print("合并了", len(report["aliases"]), "个图片组")
+    report_path = os.path.join(os.path.dirname(os.path.abspath(dst_dir)), DUPLICATE_REPORT_NAME)
+    json.dump(report, open(report_path, "w"), indent=2, ensure_ascii=False)
+    return report
+
+
+def read_png_depth(image_path):
+    """
+    从 IHDR 读取 png 的位深和颜色类型
+    :param image_path:
+    :return: (位深, 颜色类型), 不是 png 时返回 None
+    """
+    with open(image_path, "rb") as f:
+        head = f.read(26)
+    if len(head) < 26 or head[:8] != b"\x89PNG\r\n\x1a\n" or head[12:16] != b"IHDR":
+        return None
+    return head[24], head[25]
+
+
+def lossless_png_variants(im):
+    """
+    生成与原图像素完全相同的候选图片: 16 位灰度转 8 位, 去掉全不透明的 alpha, 颜色不超过 256 时转调色板
+    :param im: 已加载的原图
+    :return: [(图片, 保存参数), ...]
+    """
+    np = import_numpy()
+    if im.mode in ("I", "I;16", "I;16B"):
+        values = np.asarray(im)
+        if values.min() < 0 or values.max() > 65535 or np.any(values % 257):
+            return [(im, {})]
+        im = Image.fromarray((values // 257).astype(np.uint8), "L")
+    if im.mode in ("RGBA", "LA") and im.getchannel("A").getextrema() == (255, 255):
+        im = im.convert(im.mode[:-1])
+    variants = [(im, {})]
+    if im.mode not in ("RGB", "RGBA"):
+        return variants
+    pixels = np.asarray(im)
+    channels = pixels.shape[2]
+    keys = np.zeros(pixels.shape[:2], dtype=np.uint32)
+    for channel in range(channels):
+        keys = (keys << 8) | pixels[:, :, channel]
+    colors, indexes = np.unique(keys.ravel(), return_inverse=True)
+    if len(colors) > 256:
+        return variants
+    palette_im = Image.fromarray(indexes.reshape(keys.shape).astype(np.uint8), "P")
+    shift = 8 * (channels - 1)
+    rgb = [(int(color) >> (shift - 8 * channel)) & 0xff for color in colors for channel in range(3)]
+    palette_im.putpalette(rgb)
+    params = {"bits": next(bits for bits in (1, 2, 4, 8) if len(colors) <= 1 << bits)}
+    if channels == 4:
+        params["transparency"] = bytes(int(color) & 0xff for color in colors)
+    variants.append((palette_im, params))
+    return variants
+
+
+def optimize_png(image_path):
+    """
+    无损压缩单个 png, 尝试所有候选图片和 zlib 参数, 保留最小的结果
+    16 位彩色 png 在 Pillow 中解码后只剩 8 位, 无法保证无损, 直接跳过
+    :param image_path: 图片路径
+    :return: 图片路径, 原大小, 处理后大小, 解码失败时的错误信息
+    """
+    before = os.path.getsize(image_path)
+    try:
+        return optimize_png_file(image_path, before)
+    except IMAGE_ERRORS as e:
+        return image_path, before, before, str(e)
+
+
+def optimize_png_file(image_path, before):
+    depth = read_png_depth(image_path)
+    if depth is None or (depth[0] == 16 and depth[1] != 0):
+        return image_path, before, before, None
+    im = Image.open(image_path)
+    if getattr(im, "is_animated", False):
+        return image_path, before, before, None
+    im.load()
+    reference = im.convert("RGBA").tobytes() if depth[0] != 16 else None
+    icc_profile = im.info.get("icc_profile")
+    best = None
+    for variant, params in lossless_png_variants(im):
+        if icc_profile:
+            params["icc_profile"] = icc_profile
+        for level in PNG_COMPRESS_LEVELS:
+            for strategy in PNG_COMPRESS_STRATEGIES:
+                buffer = io.BytesIO()
+                variant.save(buffer, "PNG", compress_level=level, compress_type=strategy, **params)
+                if best is None or buffer.tell() < len(best):
+                    best = buffer.getvalue()
+    if best is None or len(best) >= before:
+        return image_path, before, before, None
+    if reference is not None and Image.open(io.BytesIO(best)).convert("RGBA").tobytes() != reference:
+        return image_path, before, before, None
+    with open(image_path, "wb") as f:
+        f.write(best)
+    return image_path, before, len(best), None
+
+
+def optimize_image_sets(dst_dir, max_workers=None):
+    """
+    并行无损压缩所有图片组中的 png, 输出每个图片组和总共节省的字节数
+    报告保存在 Assets 同级目录的 Assets.optimize.json
+    :param dst_dir: Assets 路径
+    :param max_workers: 进程数, 默认为 CPU 核数
+    :return: 报告
+    """
+    print("正在无损压缩图片,请等待....")
+    paths = [os.path.join(image_set_path, file_name)
+             for image_set_path, scales in iter_image_sets(dst_dir) for file_name in scales.values()]
+    image_sets = dict()
+    with stage("optimize_png", images=len(paths)), ProcessPoolExecutor(max_workers) as pool:
+        for image_path, before, after, error in pool.map(optimize_png, paths, chunksize=8):
+            if error:
+                print("无法解码", image_path, error)
+            name = os.path.basename(os.path.dirname(image_path))[:-len(".imageset")]
+            stat = image_sets.setdefault(name, {"before": 0, "after": 0})
+            stat["before"] += before
+            stat["after"] += after
+    total_before = sum(stat["before"] for stat in image_sets.values())
+    total_after = sum(stat["after"] for stat in image_sets.values())
+    for name, stat in sorted(image_sets.items(), key=lambda item: item[1]["after"] - item[1]["before"]):
+        if stat["after"] < stat["before"]:
+            print("%s: %d -> %d, 节省 %d 字节" % (name, stat["before"], stat["after"], stat["before"] - stat["after"]))
+    print("总共: %d -> %d, 节省 %d 字节" % (total_before, total_after, total_before - total_after))
+    report = {"image_sets": image_sets, "before": total_before, "after": total_after}
+    report_path = os.path.join(os.path.dirname(os.path.abspath(dst_dir)), OPTIMIZE_REPORT_NAME)
+    json.dump(report, open(report_path, "w"), indent=2, ensure_ascii=False)
+    return report
+
+
 def process_obfuscation_images(images_dir):
     """
     优化图片,压缩大小,修改md5
@@ -289,7 +972,30 @@ def process_obfuscation_images(images_dir):
     print("正在对所有图片进行优化处理,请等待....")
     img_obfuscation = get_executable_file_path_in_current_dir("imageObfuscation")
     cmd = "%s -s '%s' -t 90" % (img_obfuscation, images_dir)
-    os.system(cmd)
+    with stage("obfuscation"):
+        os.system(cmd)
+
+
+def build_image_assets(dst_dir, source_image_dir=None, icon_file=None, interactive=True, max_workers=None):
+    """
+    生成Assets.xcassets: 图标组, 图片组, 查重, 补齐倍图, 无损压缩, 混淆
+    :param dst_dir: 保存包的路径, 为空时为桌面
+    :param source_image_dir: 要打包进Assets.car的图片文件夹
+    :param icon_file: App图标文件
+    :param interactive: 图标有问题时是否询问
+    :param max_workers: 进程数, 默认为 CPU 核数
+    :return: 生成包的路径
+    """
+    assets_dir = generate_assets_dir(dst_dir)
+    if icon_file:
+        process_app_icon_asset(icon_file, assets_dir, interactive=interactive)
+    if source_image_dir:
+        add_all_dir_images_to_assets(source_image_dir, assets_dir)
+        dedupe_image_sets(assets_dir, max_workers=max_workers)
+        complete_image_set_renditions(assets_dir, max_workers)
+        optimize_image_sets(assets_dir, max_workers)
+    process_obfuscation_images(assets_dir)
+    return assets_dir
 
 
 def generate_image_assets():
@@ -298,30 +1004,39 @@ def generate_image_assets():
     :return:
     """
     dst_dir = input("请输入要输出的文件夹,回车选择桌面\n").strip()
-    assets_dir = generate_assets_dir(dst_dir)
     icon_file = input("请输入App图标文件,支持png和jpeg\n").strip()
-    if icon_file:
-        process_app_icon_asset(icon_file, assets_dir)
     source_image_dir = input("请输入要打包进Assets.car的图片文件夹,支持png和jpeg\n").strip()
-    if source_image_dir:
-        add_all_dir_images_to_assets(source_image_dir, assets_dir)
-    process_obfuscation_images(assets_dir)
+    build_image_assets(dst_dir, source_image_dir, icon_file)
     print("图片添加完毕!")
 
 def usage():
     print("Use:python3 Assets.py -f Icon.png -d ~/Desktop")
+    print("    python3 Assets.py -m icons.json  按清单批量生成图标组, 清单格式:")
+    print('        [{"source": "Icon.png", "catalog": "brand1/Assets.xcassets", "name": "AppIcon"}, ...]')
+    print("    python3 Assets.py -c -d ~/Desktop/Assets.xcassets  补齐图片组缺少的@1x/@2x图")
+    print("    python3 Assets.py -u [--similar 4] [--collapse] -d ~/Desktop/Assets.xcassets  查找(合并)重复图片组")
+    print("    python3 Assets.py -o -d ~/Desktop/Assets.xcassets  无损压缩图片组中的png")
+    print("环境变量 PIPELINE_TRACE=trace.json 统计各阶段耗时, PIPELINE_PROFILE=out.prof 打开 cProfile")
 
 if __name__ == "__main__":
+    enable_from_env()
     try:
         opts_list, _ = getopt.getopt(sys.argv[1:],
-                                "hf:d:",
-                                ["help", "file=","dir="])
+                                "hf:d:cuom:",
+                                ["help", "file=", "dir=", "complete", "dedupe", "similar=", "collapse",
+                                 "optimize", "manifest="])
     except getopt.GetoptError:
         usage()
         sys.exit(1)
 
     icon_file = None
     assets_dir = None
+    complete_renditions = False
+    dedupe = False
+    similar_distance = None
+    collapse_duplicates = False
+    optimize = False
+    manifest = None
     for o, a in opts_list:
         if o in ("-h", "--help"):
             usage()
@@ -330,9 +1045,32 @@ if __name__ == "__main__":
             icon_file = a
         if o in ("-d", "--dir"):
             assets_dir = a
+        if o in ("-c", "--complete"):
+            complete_renditions = True
+        if o in ("-u", "--dedupe"):
+            dedupe = True
+        if o == "--similar":
+            similar_distance = int(a)
+        if o == "--collapse":
+            collapse_duplicates = True
+        if o in ("-o", "--optimize"):
+            optimize = True
+        if o in ("-m", "--manifest"):
+            manifest = a
+    if manifest is not None:
+        if process_app_icon_manifest(manifest)["failed"]:
+            sys.exit(1)
+        sys.exit(0)
     # 保证参数正确
-    if icon_file is None or assets_dir is None:
+    if assets_dir is None or (icon_file is None and not complete_renditions and not dedupe and not optimize):
         usage()
         sys.exit(1)
 
-    process_app_icon_asset(icon_file, assets_dir)
+    if dedupe:
+        dedupe_image_sets(assets_dir, similar_distance, collapse_duplicates)
+    if complete_renditions:
+        print("生成了", complete_image_set_renditions(assets_dir), "张图片")
+    if optimize:
+        optimize_image_sets(assets_dir)
+    if icon_file is not None:
+        process_app_icon_asset(icon_file, assets_dir)
@@ -0,0 +1,219 @@
+"""
+compare.py 的性能和准确性测试
+
+用 macho_fixture.py 生成不同大小的 ipa, 分别测量解压, 解析, 比较的耗时, 吞吐量和峰值内存,
+并用生成时记录的精确变更数检查比较结果. 每个步骤在独立的子进程中运行, 峰值内存互不影响.
+
+Use:python3 bench_compare.py [--sizes 10,100,1000] [--work-dir /dev/shm] [--stored] [--fat] [--json out.json]
+"""
+
+import contextlib
+import getopt
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import compare
+import macho_fixture
+from pipeline_trace import max_rss
+
+DEFAULT_SIZES = (10, 100, 1000)
+# 生成 fixture 时只有 ADRP 页地址变化的指令比例, 用来检查分类统计
+ADDRESS_RATE = 0.05
+
+
+class NullText:
+    """
+    丢弃 MachOComparer 的输出
+    """
+
+    def insert(self, *_args):
+        pass
+
+    def delete(self, *_args):
+        pass
+
+
+def run_step(step, args):
+    """
+    在子进程中运行一个步骤
+    :param step: 步骤名
+    :param args: 步骤参数
+    :return: 耗时(秒), 峰值内存(字节), 步骤结果
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return run_step_quietly(step, args)
+
+
+def run_step_quietly(step, args):
+    start = time.perf_counter()
+    if step == 'extract':
+        path = compare.decompression(args['ipa'])
+        shutil.rmtree(path)
+        result = None
+    elif step == 'parse':
+        result = compare.init_macho_info(args['binary']) is not None
+    elif step == 'diff_machine_code':
+        info1 = compare.init_macho_info(args['binary1'])
+        info2 = compare.init_macho_info(args['binary2'])
+        start = time.perf_counter()
+        result = compare.diff_machine_code(args['binary1'], info1, args['binary2'], info2)['changed']
+    elif step == 'instruction_classes':
+        info1 = compare.init_macho_info(args['binary1'])
+        info2 = compare.init_macho_info(args['binary2'])
+        start = time.perf_counter()
+        result = compare.instruction_class_histogram(args['binary1'], info1, args['binary2'], info2, True)
+        result = result['address_only']
+    elif step == 'code_chunks':
+        info1 = compare.init_macho_info(args['binary1'])
+        info2 = compare.init_macho_info(args['binary2'])
+        start = time.perf_counter()
+        compare.code_similarity(args['binary1'], info1, args['binary2'], info2, True)
+        result = None
+    elif step == 'entropy_scan':
+        info = compare.init_macho_info(args['binary1'])
+        start = time.perf_counter()
+        sections = compare.scan_section_entropy(args['binary1'], info)
+        result = sum(len(ranges) for _windows, ranges in sections.values())
+    elif step == 'strings':
+        result = compare.MachOComparer(NullText()).compare_text(args['binary1'], args['binary2'])
+    elif step == 'symbols':
+        result = compare.MachOComparer(NullText()).compare_symbols(args['binary1'], args['binary2'])
+    elif step == 'objc':
+        result = compare.MachOComparer(NullText()).compare_objc(args['binary1'], args['binary2'])
+    elif step == 'compare_ipa':
+        compare.MachOComparer(NullText()).compare_ipa(args['ipa1'], args['ipa2'])
+        result = None
+    else:
+        raise ValueError(step)
+    return time.perf_counter() - start, max_rss(), result
+
+
+def measure(step, args):
+    """
+    用新的子进程运行步骤, 避免前面步骤的内存影响峰值统计
+    :param step:
+    :param args:
+    :return: run_step 的结果
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(run_step, step, args).result()
+
+
+def bench_size(size_mb, work_dir, compression, fat):
+    """
+    测试一种大小
+    :param size_mb: 主二进制 __text 大小(MB)
+    :param work_dir: 工作目录
+    :param compression: ipa 压缩方式
+    :param fat: 是否生成 fat 二进制
+    :return: 结果列表
+    """
+    size_dir = tempfile.mkdtemp(prefix='bench_{}MB_'.format(size_mb), dir=work_dir)
+    ipa1 = os.path.join(size_dir, 'origin.ipa')
+    ipa2 = os.path.join(size_dir, 'obfuscated.ipa')
+    text_size = size_mb * 1024 * 1024
+    rows = list()
+    try:
+        start = time.perf_counter()
+        expected = macho_fixture.build_ipa_pair(ipa1, ipa2, os.path.join(size_dir, 'tmp'), text_size=text_size,
+                                                address_rate=ADDRESS_RATE, fat=fat, compression=compression)
+        print('{} MB: 生成 fixture {:.1f}s'.format(size_mb, time.perf_counter() - start))
+        main_expected = next(iter(expected.values()))
+        path1 = compare.decompression(ipa1)
+        path2 = compare.decompression(ipa2)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                binary1, _frameworks = compare.find_main_and_framework(path1)
+                binary2, _frameworks = compare.find_main_and_framework(path2)
+            binaries = {'binary1': binary1, 'binary2': binary2}
+            steps = (
+                ('extract', {'ipa': ipa1}, os.path.getsize(ipa1), None),
+                ('parse', {'binary': binary1}, None, True),
+                ('diff_machine_code', binaries, text_size,
+                 main_expected['text_changed'] + main_expected['address_only']),
+                ('instruction_classes', binaries, text_size, main_expected['address_only']),
+                ('code_chunks', binaries, 2 * text_size, None),
+                ('entropy_scan', binaries, text_size, 0),
+                ('strings', binaries, None, {
+                    'classname': main_expected['objc_classname'], 'methname': main_expected['objc_methname'],
+                    'cstring': main_expected['cstring'], 'methtype': main_expected['objc_methtype']}),
+                ('symbols', binaries, None, {
+                    'symtab': main_expected['symbols_changed'], 'exports': main_expected['exports_changed']}),
+                ('objc', binaries, None, {
+                    'classes': main_expected['objc_classes_changed'], 'methods': main_expected['objc_methods_changed'],
+                    'selrefs': main_expected['objc_selrefs_changed'], 'protocols': 0}),
+                ('compare_ipa', {'ipa1': ipa1, 'ipa2': ipa2}, None, None),
+            )
+            for step, args, volume, expected_result in steps:
+                seconds, peak, result = measure(step, args)
+                row = {
+                    'size_mb': size_mb, 'step': step, 'seconds': seconds, 'peak_rss_mb': peak / 1048576,
+                    'mb_per_second': volume / 1048576 / seconds if volume and seconds else None,
+                    'accurate': None if expected_result is None else result == expected_result,
+                }
+                rows.append(row)
+                print_row(row)
+        finally:
+            shutil.rmtree(path1)
+            shutil.rmtree(path2)
+    finally:
+        shutil.rmtree(size_dir)
+    return rows
+
+
+def print_row(row):
+    throughput = '{:10.1f}'.format(row['mb_per_second']) if row['mb_per_second'] else '{:>10}'.format('-')
+    accurate = {None: '-', True: 'ok', False: 'WRONG'}[row['accurate']]
+    print('{:>8} {:<22} {:10.3f} {} {:10.1f} {:>6}'.format(
+        row['size_mb'], row['step'], row['seconds'], throughput, row['peak_rss_mb'], accurate))
+
+
+def usage():
+    print("Use:python3 bench_compare.py [--sizes 10,100,1000] [--work-dir /dev/shm] [--stored] [--fat] "
+          "[--json out.json]")
+
+
+if __name__ == "__main__":
+    try:
+        opts_list, _ = getopt.getopt(sys.argv[1:], "h", ["help", "sizes=", "work-dir=", "stored", "fat", "json="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    sizes = DEFAULT_SIZES
+    bench_dir = tempfile.gettempdir()
+    zip_compression = zipfile.ZIP_DEFLATED
+    fat_binary = False
+    json_path = None
+    for o, a in opts_list:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(1)
+        if o == "--sizes":
+            sizes = [int(size) for size in a.split(',')]
+        if o == "--work-dir":
+            bench_dir = a
+        if o == "--stored":
+            zip_compression = zipfile.ZIP_STORED
+        if o == "--fat":
+            fat_binary = True
+        if o == "--json":
+            json_path = a
+
+    print('{:>8} {:<22} {:>10} {:>10} {:>10} {:>6}'.format('MB', 'step', 'seconds', 'MB/s', 'peak MB', 'check'))
+    all_rows = list()
+    for bench_size_mb in sizes:
+        all_rows.extend(bench_size(bench_size_mb, bench_dir, zip_compression, fat_binary))
+    if json_path:
+        json.dump(all_rows, open(json_path, 'w'), indent=2)
+    if any(row['accurate'] is False for row in all_rows):
+        sys.exit(1)
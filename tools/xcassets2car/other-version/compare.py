@@ -1,26 +1,438 @@
+import bisect
+import functools
+import getopt
+import hashlib
+import heapq
+import mmap
 import os
 import random
 import shutil
 import string
+import struct
 import sys
 import zipfile
-from tkinter import Tk, Frame, Button, StringVar, Entry, Text, END, messagebox
-import tkinter.filedialog
-
-try:
-    import magic
-except ImportError:
-    print('pip3 install python-magic-bin==0.4.14')
-    sys.exit()
-try:
-    from macholib.MachO import MachO
-except ImportError:
-    print('pip3 install macholib==1.9')
-    sys.exit()
-
-
-class CompareApplication:
+
+from pipeline_trace import stage, count, enable_from_env
+
+# tkinter, macholib, numpy 都在用到的地方才导入, 无界面模式和只查找 Mach-O 时启动更快
+# 与 tkinter.END 相同
+END = 'end'
+
+# 流式比较 __text 时每个窗口的大小, 必须是 4 的整数倍(arm64 指令长度)
+DIFF_WINDOW_SIZE = 4 * 1024 * 1024
+# 变更密度图使用的字符, 从低到高
+DENSITY_CHARS = ' .:-=+*#%@'
+
+# arm64 指令按顶层编码分组(op0 = bits[28:25]), ADR/ADRP 单独成类
+INSN_CLASSES = ('other', 'dp_imm', 'adr', 'branch', 'ldst', 'dp_reg', 'simd_fp', 'sve')
+OP0_CLASS_TABLE = (
+    0, 0, 7, 0,  # 0000 保留/SME, 0001 未分配, 0010 SVE, 0011 未分配
+    4, 5, 4, 6,  # 0100 load/store, 0101 寄存器数据处理, 0110 load/store, 0111 SIMD&FP
+    1, 1, 3, 3,  # 100x 立即数数据处理, 101x 分支/异常/系统
+    4, 5, 4, 6,  # 1100 load/store, 1101 寄存器数据处理, 1110 load/store, 1111 SIMD&FP
+)
+ADR_CLASS = INSN_CLASSES.index('adr')
+
+# Mach-O 头部魔数, 按大端读取文件前 4 字节得到的值
+MH_MAGIC = 0xfeedface
+MH_CIGAM = 0xcefaedfe
+MH_MAGIC_64 = 0xfeedfacf
+MH_CIGAM_64 = 0xcffaedfe
+FAT_MAGIC = 0xcafebabe
+FAT_CIGAM = 0xbebafeca
+FAT_MAGIC_64 = 0xcafebabf
+FAT_CIGAM_64 = 0xbfbafeca
+# fat 头部中架构数量的上限, 用来和同样以 0xcafebabe 开头的 Java class 文件区分
+FAT_MAX_ARCHS = 32
+
+LC_SYMTAB = 0x2
+LC_DYLD_INFO = 0x22
+LC_DYLD_INFO_ONLY = 0x80000022
+LC_DYLD_EXPORTS_TRIE = 0x80000033
+LC_DYLD_CHAINED_FIXUPS = 0x80000034
+LC_ENCRYPTION_INFO = 0x21
+LC_ENCRYPTION_INFO_64 = 0x2c
+CPU_TYPE_ARM64 = 0x0100000c
+# nlist 结构
+NLIST_32_FIELDS = [('n_strx', '<u4'), ('n_type', 'u1'), ('n_sect', 'u1'), ('n_desc', '<u2'), ('n_value', '<u4')]
+NLIST_64_FIELDS = [('n_strx', '<u4'), ('n_type', 'u1'), ('n_sect', 'u1'), ('n_desc', '<u2'), ('n_value', '<u8')]
+N_STAB = 0xe0
+N_TYPE = 0x0e
+N_UNDF = 0x0
+
+# __DATA* 段中需要解析的 objc 节
+OBJC_LIST_SECTIONS = (b'__objc_classlist', b'__objc_catlist', b'__objc_protolist', b'__objc_selrefs')
+# chained fixups 的指针格式(dyld_chained_starts_in_segment.pointer_format)
+DYLD_CHAINED_PTR_ARM64E = 1
+DYLD_CHAINED_PTR_64 = 2
+DYLD_CHAINED_PTR_64_OFFSET = 6
+DYLD_CHAINED_PTR_ARM64E_USERLAND = 9
+DYLD_CHAINED_PTR_ARM64E_USERLAND24 = 12
+# 方法列表/名字数量超过这个值认为数据损坏
+OBJC_MAX_COUNT = 1 << 20
+OBJC_NAME_TYPES = ('classes', 'methods', 'selrefs', 'protocols')
+
+# 内容定义分块: 在指令序列上计算滚动哈希, 哈希满足条件的位置作为块边界, 函数移动或插入代码后大部分块仍然相同
+# 滚动哈希窗口, 平均/最小/最大块长度, 单位都是指令(4 字节), 最小块长度不能小于窗口
+CHUNK_HASH_WINDOW = 16
+CHUNK_AVG_WORDS = 64
+CHUNK_MIN_WORDS = 16
+CHUNK_MAX_WORDS = 512
+MINHASH_PERMUTATIONS = 128
+
+# 熵扫描: 每个窗口的字节熵(bits/byte), arm64 机器码一般在 6 左右, 加密或压缩的数据接近 8
+ENTROPY_WINDOW_SIZE = 4096
+ENTROPY_THRESHOLD = 7.5
+# __text 中高熵窗口超过这个比例时认为已加壳, 不再比较机器码和字符串
+PACKED_TEXT_RATIO = 0.5
+# init_macho_info 中记录的 __TEXT 节, 按这个顺序扫描
+ENTROPY_SECTIONS = (('__text', 'text'), ('__cstring', 'cstring'), ('__objc_classname', 'class'),
+                    ('__objc_methname', 'methname'), ('__objc_methtype', 'methtype'))
+
+
+class ConsoleText:
+    """
+    无界面模式下代替 tkinter.Text, 输出直接写到终端
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def insert(self, _index, chars, *tags):
+        if 'warn' in tags and self.stream.isatty():
+            chars = '\033[31m{}\033[0m'.format(chars)
+        self.stream.write(chars)
+
+    def delete(self, *_args):
+        pass
+
+    def tag_config(self, *_args, **_kwargs):
+        pass
+
+
+class MachOComparer:
+    """
+    比较两个 ipa 中的二进制, 结果输出到 text(tkinter.Text 或 ConsoleText)
+    """
+
+    def __init__(self, text, exclude_address=True, similarity=False):
+        self.text = text
+        self.exclude_address = exclude_address
+        # 是否按内容定义分块比较机器码, 不受函数移动和插入代码的影响
+        self.similarity = similarity
+        # 最近一次 compare_ipa 中因为加密或加壳跳过比较的二进制
+        self.skipped = list()
+
+    def compare_ipa(self, ipa_path1, ipa_path2):
+        """
+        解压两个 ipa, 比较主二进制和同名的库二进制
+        :param ipa_path1: 原始 ipa
+        :param ipa_path2: 混淆 ipa
+        :return:
+        """
+        path1 = decompression(ipa_path1)
+        path2 = decompression(ipa_path2)
+        try:
+            self.compare_payloads(path1, path2)
+        finally:
+            shutil.rmtree(path1)
+            shutil.rmtree(path2)
+
+    def compare_payloads(self, path1, path2):
+        """
+        比较两个已经解压的 ipa
+        :param path1: 原始 ipa 解压目录
+        :param path2: 混淆 ipa 解压目录
+        :return:
+        """
+        self.skipped = list()
+        main_path1, frameworks_list1 = find_main_and_framework(path1)
+        main_path2, frameworks_list2 = find_main_and_framework(path2)
+        if not main_path1:
+            self.text.insert(END, "原 ipa 没有找到主儿进制")
+            return
+        if not main_path2:
+            self.text.insert(END, "混淆 ipa 没有找到主儿进制")
+            return
+
+        self.text.insert(END, '主二进制 {}: \n'.format(os.path.basename(main_path1)))
+        self.compare_binary(main_path1, main_path2)
+        for f_name in frameworks_list1:
+            self.text.insert(END, '库二进制 {}: \n'.format(os.path.basename(f_name)))
+            new_f_name = None
+            for _name in frameworks_list2:
+                if _name.endswith(os.path.basename(f_name)):
+                    new_f_name = _name
+                    break
+            if not new_f_name:
+                self.text.insert(END, '    混淆 ipa 中没有这个库\n\n', 'warn')
+                continue
+            self.compare_binary(f_name, new_f_name)
+
+    def compare_binary(self, path1, path2):
+        """
+        比较一对二进制
+        先检查加密和加壳, 已加密时 __TEXT 中都是密文, 只比较不加密的符号表
+        :param path1:
+        :param path2:
+        :return:
+        """
+        if not self.check_encryption(path1, path2):
+            self.skipped.append(path1)
+            self.compare_symbols(path1, path2)
+            return
+        info1 = init_macho_info(path1)
+        info2 = init_macho_info(path2)
+        # 指令总数和分类统计在同一次流式读取中完成
+        with stage("diff_machine_code"):
+            result = diff_machine_code(path1, info1, path2, info2, classify=True,
+                                       exclude_address=self.exclude_address)
+        self.compare_machine_code(result)
+        self.compare_instruction_classes(result['classes'])
+        if self.similarity:
+            self.compare_code_chunks(path1, path2)
+        self.compare_text(path1, path2)
+        self.compare_symbols(path1, path2)
+        self.compare_objc(path1, path2)
+
+    def check_encryption(self, path1, path2):
+        """
+        检查 FairPlay 加密(cryptid)和 __TEXT 各节的熵
+        :param path1:
+        :param path2:
+        :return: 是否可以比较 __TEXT 中的内容
+        """
+        comparable = True
+        for label, path in (('原始', path1), ('混淆', path2)):
+            info = init_macho_info(path)
+            if info is None:
+                continue
+            if info.get('crypt_id'):
+                self.text.insert(END, '    {}二进制已加密(cryptid={}, 偏移 0x{:x}, 长度 {}), 需要先解密, '
+                                      '跳过机器码和字符串比较\n'.format(
+                                          label, info['crypt_id'], info['crypt_offset'], info['crypt_size']), 'warn')
+                comparable = False
+                continue
+            with stage("entropy_scan"):
+                sections = scan_section_entropy(path, info)
+            for sect_name, (windows, ranges) in sections.items():
+                high = sum((end - start + ENTROPY_WINDOW_SIZE - 1) // ENTROPY_WINDOW_SIZE for start, end in ranges)
+                if not high:
+                    continue
+                self.text.insert(END, '    {}二进制 {}: {}/{} 个窗口熵高于 {} bits, 可能已加壳或加密: {}\n'.format(
+                    label, sect_name, high, windows, ENTROPY_THRESHOLD,
+                    ', '.join('0x{:x}-0x{:x}'.format(start, end) for start, end in ranges[:8])), 'warn')
+                if sect_name == '__text' and high >= windows * PACKED_TEXT_RATIO:
+                    comparable = False
+        if not comparable:
+            self.text.insert(END, '\n')
+        return comparable
+
+    def compare_machine_code(self, result):
+        """
+        输出机器码比较结果
+        两个 __text 段按窗口流式读取, 长度不同时只比较公共部分并给出长度差
+        :param result: diff_machine_code 的结果
+        :return:
+        """
+        count("text_bytes_diffed", result['words'] * 4)
+        if result['size1'] != result['size2']:
+            self.text.insert(END, '    机器码:__text段长度不同({} / {}, 相差 {} 字节), 只比较公共部分\n'.format(
+                result['size1'], result['size2'], result['size2'] - result['size1']), 'warn')
+        total = result['words']
+        diff_counter = result['changed']
+        self.text.insert(END, '    机器码:总指令数: {}\n'.format(total))
+        self.text.insert(END, '    机器码:变更的指令数: {}\n'.format(diff_counter))
+        if not total:
+            self.text.insert(END, '\n')
+            return
+        if diff_counter / total < 0.1:
+            self.text.insert(END, '    机器码:混淆百分比: {:.2%}\n'.format(diff_counter / total), 'warn')
+        else:
+            self.text.insert(END, '    机器码:混淆百分比: {:.2%}\n'.format(diff_counter / total))
+        self.text.insert(END, '    机器码:变更密度(每格 {} KB):\n'.format(DIFF_WINDOW_SIZE // 1024))
+        for line in format_density_map(result['windows']):
+            self.text.insert(END, '    {}\n'.format(line))
+        self.text.insert(END, '\n')
+
+    def compare_instruction_classes(self, result):
+        """
+        输出按指令分类统计的变更
+        勾选排除地址变更时, 只是立即数地址不同的指令不计入混淆
+        :param result: diff_machine_code(classify=True) 结果中的 'classes'
+        :return:
+        """
+        exclude_address = self.exclude_address
+        for name in INSN_CLASSES:
+            total = result['total'][name]
+            if not total:
+                continue
+            self.text.insert(END, '    指令分类 {:<8}: 总数: {:<10} 变更: {:<10} {:.2%}\n'.format(
+                name, total, result['changed'][name], result['changed'][name] / total))
+        self.text.insert(END, '    只有地址变更的指令数: {}{}\n'.format(
+            result['address_only'], '(已排除)' if exclude_address else ''))
+        words = sum(result['total'].values())
+        if words:
+            changed = sum(result['changed'].values())
+            tag = 'warn' if changed / words < 0.1 else ''
+            self.text.insert(END, '    机器码:有效混淆百分比: {:.2%}\n'.format(changed / words), tag)
+        self.text.insert(END, '\n')
+
+    def compare_code_chunks(self, path1, path2):
+        """
+        按内容定义分块比较机器码, 统计混淆后的代码中有多少块与原始代码完全相同(位置不限)
+        勾选排除地址变更时, 分块前先清除地址立即数
+        :param path1:
+        :param path2:
+        :return:
+        """
+        info1 = init_macho_info(path1)
+        info2 = init_macho_info(path2)
+        with stage("code_chunks"):
+            result = code_similarity(path1, info1, path2, info2, self.exclude_address)
+        if not result['bytes2']:
+            return
+        verbatim = result['verbatim_bytes'] / result['bytes2']
+        self.text.insert(END, '    机器码(分块):块数: {} / {}, 平均块长度: {:.0f} 字节\n'.format(
+            result['chunks1'], result['chunks2'], result['bytes2'] / max(1, result['chunks2'])))
+        self.text.insert(END, '    机器码(分块):原样保留的代码: {} 字节, {:.2%}\n'.format(result['verbatim_bytes'], verbatim),
+                         'warn' if verbatim > 0.9 else '')
+        self.text.insert(END, '    机器码(分块):块集合相似度: {:.2%}, MinHash 估计: {:.2%}\n\n'.format(
+            result['jaccard'], result['minhash_jaccard']))
+
+    def compare_symbols(self, path1, path2):
+        """
+        比较符号表和导出表中保留下来的符号名
+        :param path1:
+        :param path2:
+        :return: {'symtab': 混淆的数量, 'exports': 混淆的数量}
+        """
+        info1 = init_macho_info(path1)
+        info2 = init_macho_info(path2)
+        with stage("section_read", kind='symbols'):
+            symbols1 = read_symbol_names(path1, info1)
+            symbols2 = read_symbol_names(path2, info2)
+            exports1 = read_export_names(path1, info1)
+            exports2 = read_export_names(path2, info2)
+        with stage("diff_names", kind='symbols'):
+            return {'symtab': self.report_names(diff_name_sets(symbols1, symbols2), 'symtab'),
+                    'exports': self.report_names(diff_name_sets(exports1, exports2), 'exports')}
+
+    def report_names(self, result, sub_type):
+        """
+        输出名字集合的比较结果
+        :param result: diff_name_sets 的结果
+        :param sub_type:
+        :return: 混淆的数量
+        """
+        total = result['total']
+        self.text.insert(END, '    {}: 总数量: {}\n'.format(sub_type, total))
+        if not total:
+            self.text.insert(END, '\n')
+            return 0
+        self.text.insert(END, '    {}: 未混淆的数量: {}\n'.format(sub_type, result['survived']))
+        percent = 1 - result['survived'] / total
+        if percent < 0.1:
+            self.text.insert(END, '    {}: 百分比: {:.2%}\n'.format(sub_type, percent), 'warn')
+        else:
+            self.text.insert(END, '    {}: 百分比: {:.2%}\n'.format(sub_type, percent))
+        for name in result['samples']:
+            self.text.insert(END, '        {}\n'.format(name.decode('utf-8', 'replace')))
+        self.text.insert(END, '\n')
+        return total - result['survived']
+
+    def compare_text(self, path1, path2):
+        """
+        比较 TEXT 段
+        :param path1:
+        :param path2:
+        :return: {sub_type: 混淆的数量}
+        """
+        info1 = init_macho_info(path1)
+        info2 = init_macho_info(path2)
+        with stage("section_read", kind='text'), open(path1, 'rb') as f1:
+            f1.seek(info1.get('class_offset', 0))
+            class_body1 = f1.read(info1.get('class_size', 0))
+            f1.seek(info1.get('cstring_offset', 0))
+            cstring_body1 = f1.read(info1.get('cstring_size', 0))
+            f1.seek(info1.get('methname_offset', 0))
+            methname_body1 = f1.read(info1.get('methname_size', 0))
+        with stage("section_read", kind='text'), open(path2, 'rb') as f2:
+            f2.seek(info2.get('class_offset', 0))
+            class_body2 = f2.read(info2.get('class_size', 0))
+            f2.seek(info2.get('cstring_offset', 0))
+            cstring_body2 = f2.read(info2.get('cstring_size', 0))
+            f2.seek(info2.get('methname_offset', 0))
+            methname_body2 = f2.read(info2.get('methname_size', 0))
+
+        changed = {
+            'classname': self.compare_body(class_body1, class_body2, 'classname'),
+            'methname': self.compare_body(methname_body1, methname_body2, 'methname'),
+            'cstring': self.compare_body(cstring_body1, cstring_body2, 'cstring'),
+        }
+        if info1.get('methtype_size', 0) and info2.get('methtype_size', 0):
+            with open(path1, 'rb') as f1:
+                f1.seek(info1.get('methtype_offset', 0))
+                methtype_body1 = f1.read(info1.get('methtype_size', 0))
+            with open(path2, 'rb') as f2:
+                f2.seek(info2.get('methtype_offset', 0))
+                methtype_body2 = f2.read(info2.get('methtype_size', 0))
+            changed['methtype'] = self.compare_body(methtype_body1, methtype_body2, 'methtype')
+        return changed
+
+    def compare_objc(self, path1, path2):
+        """
+        比较运行时可见的 objc 名字: 类名, 方法名, selector 引用, 协议名
+        :param path1:
+        :param path2:
+        :return: {sub_type: 混淆的数量}
+        """
+        info1 = init_macho_info(path1)
+        info2 = init_macho_info(path2)
+        with stage("section_read", kind='objc'):
+            names1 = read_objc_names(path1, info1)
+            names2 = read_objc_names(path2, info2)
+        with stage("diff_names", kind='objc'):
+            result = {sub_type: self.report_names(diff_name_sets(names1[sub_type], names2[sub_type]),
+                                                  'objc ' + sub_type)
+                      for sub_type in OBJC_NAME_TYPES}
+            all1 = set().union(*names1.values())
+            all2 = set().union(*names2.values())
+            self.report_names(diff_name_sets(all1, all2), 'objc 运行时可见名字')
+        return result
+
+    def compare_body(self, body1, body2, sub_type):
+        """
+
+        :param body1:
+        :param body2:
+        :param sub_type:
+        :return: 混淆的数量
+        """
+        with stage("diff_strings", kind=sub_type):
+            arr1 = body1.split(b'\x00')
+            arr2 = body2.split(b'\x00')
+            total = len(arr1)
+            counter = 0
+            for index, class_name in enumerate(arr1):
+                if class_name:
+                    if index >= len(arr2) or class_name != arr2[index]:
+                        counter += 1
+        self.text.insert(END, '    {}: 总数量: {}\n'.format(sub_type, total))
+        self.text.insert(END, '    {}: 混淆的数量: {}\n'.format(sub_type, counter))
+        if counter / total < 0.1:
+            self.text.insert(END, '    {}: 百分比: {:.2%}\n'.format(sub_type, counter / total), 'warn')
+        else:
+            self.text.insert(END, '    {}: 百分比: {:.2%}\n'.format(sub_type, counter / total))
+
+        self.text.insert(END, '\n')
+        return counter
+
+
+class CompareApplication(MachOComparer):
     def __init__(self):
+        from tkinter import Tk, Frame, Button, StringVar, BooleanVar, Checkbutton, Entry, Text
+
         window = Tk()  # 创建一个窗口
         window.title("MachO compare")  # 设置标题
         center_window(window, 1200, 800)
@@ -50,9 +462,17 @@ class CompareApplication:
         frame2.pack(expand=False, side='top', fill='x')  # 将框架frame2放置在window中
         start_btn = Button(frame2, text='START', command=self.start)
         start_btn.pack()
+        self.exclude_address_var = BooleanVar(value=True)
+        exclude_btn = Checkbutton(frame2, text='机器码分类统计排除地址变更(ADRP/ADR/ADD/B/BL 立即数)',
+                                  variable=self.exclude_address_var)
+        exclude_btn.pack()
+        self.similarity_var = BooleanVar(value=False)
+        similarity_btn = Checkbutton(frame2, text='按内容分块比较机器码(不受函数移动和插入代码影响)',
+                                     variable=self.similarity_var)
+        similarity_btn.pack()
 
         # 创建格式化文本，并放置在window中
-        self.text = Text(window)
+        super().__init__(Text(window))
         self.text.pack(expand=True, fill='both')
         self.text.insert(END, "Tip\n")
         self.text.insert(END, "1. 选择两个要比较的 ipa 文件, 或者粘贴路径\n")
@@ -67,6 +487,8 @@ class CompareApplication:
         获取第一个路径
         :return:
         """
+        import tkinter.filedialog
+
         filename = tkinter.filedialog.askopenfilename()
         if filename:
             self.entry_path1.delete(0, END)
@@ -80,6 +502,8 @@ class CompareApplication:
         获取第二个路径
         :return:
         """
+        import tkinter.filedialog
+
         filename = tkinter.filedialog.askopenfilename()
         if filename:
             self.entry_path2.delete(0, END)
@@ -93,6 +517,8 @@ class CompareApplication:
         开始解析,比较
         :return:
         """
+        from tkinter import messagebox
+
         ipa_path1 = self.entry_path1.get()
         ipa_path2 = self.entry_path2.get()
         if not ipa_path1 or not ipa_path2:
@@ -105,139 +531,101 @@ class CompareApplication:
             messagebox.showerror("Error", "混淆 ipa 文件不正确")
             return
         self.text.delete('1.0', END)
-        path1 = decompression(ipa_path1)
-        path2 = decompression(ipa_path2)
-
-        try:
-            main_path1, frameworks_list1 = find_main_and_framework(path1)
-            main_path2, frameworks_list2 = find_main_and_framework(path2)
-            print(main_path1, frameworks_list1)
-            print(main_path2, frameworks_list2)
-            if not main_path1:
-                self.text.insert(END, "原 ipa 没有找到主儿进制")
-                return
-            if not main_path2:
-                self.text.insert(END, "混淆 ipa 没有找到主儿进制")
-                return
-
-            self.text.insert(END, '主二进制 {}: \n'.format(os.path.basename(main_path1)))
-
-            self.compare_machine_code(main_path1, main_path2)
-            self.compare_text(main_path1, main_path2)
-            for f_name in frameworks_list1:
-                self.text.insert(END, '库二进制 {}: \n'.format(os.path.basename(f_name)))
-                new_f_name = None
-                for _name in frameworks_list2:
-                    if _name.endswith(os.path.basename(f_name)):
-                        new_f_name = _name
-                        break
-                self.compare_machine_code(f_name, new_f_name)
-                self.compare_text(f_name, new_f_name)
+        self.exclude_address = self.exclude_address_var.get()
+        self.similarity = self.similarity_var.get()
+        self.compare_ipa(ipa_path1, ipa_path2)
 
-        finally:
-            shutil.rmtree(path1)
-            shutil.rmtree(path2)
 
-    def compare_machine_code(self, path1, path2):
-        """
-        比较机器码
-        :param path1:
-        :param path2:
-        :return:
-        """
-        info1 = init_macho_info(path1)
-        info2 = init_macho_info(path2)
-        # print(info1)
-        # print(info2)
-        with open(path1, 'rb') as f1:
-            f1.seek(info1.get('text_offset'))
-            body1 = f1.read(info1.get('text_size'))
-        with open(path2, 'rb') as f2:
-            f2.seek(info2.get('text_offset'))
-            body2 = f2.read(info2.get('text_size'))
-        content = ''
-        if len(body1) != len(body2):
-            content += '__text段长度不同,混淆有问题'
-            return
-        step = 4
-        arr1 = [body1[i:i + step] for i in range(0, len(body1), step)]
-        arr2 = [body2[i:i + step] for i in range(0, len(body2), step)]
-        self.text.insert(END, '    机器码:总指令数: {}\n'.format(len(arr1)))
-        diff_counter = 0
-        for index, point in enumerate(arr1):
-            if point != arr2[index]:
-                diff_counter += 1
-        self.text.insert(END, '    机器码:变更的指令数: {}\n'.format(diff_counter))
-        if diff_counter / len(arr1) < 0.1:
-            self.text.insert(END, '    机器码:混淆百分比: {:.2%}\n'.format(diff_counter / len(arr1)), 'warn')
-        else:
-            self.text.insert(END, '    机器码:混淆百分比: {:.2%}\n'.format(diff_counter / len(arr1)))
-        self.text.insert(END, '\n')
-        # info2.get('text_offset')
-        # info2.get('text_size')
+def import_numpy():
+    """
+    按需导入 numpy, 只有比较二进制内容时才需要
+    :return: numpy 模块
+    """
+    try:
+        import numpy
+    except ImportError:
+        print('pip3 install numpy')
+        sys.exit()
+    return numpy
 
-    def compare_text(self, path1, path2):
-        """
-        比较 TEXT 段
-        :param path1:
-        :param path2:
-        :return:
-        """
-        info1 = init_macho_info(path1)
-        info2 = init_macho_info(path2)
-        print(info1)
-        with open(path1, 'rb') as f1:
-            f1.seek(info1.get('class_offset'))
-            class_body1 = f1.read(info1.get('class_size'))
-            f1.seek(info1.get('cstring_offset'))
-            cstring_body1 = f1.read(info1.get('cstring_size'))
-            f1.seek(info1.get('methname_offset'))
-            methname_body1 = f1.read(info1.get('methname_size'))
-        with open(path2, 'rb') as f2:
-            f2.seek(info2.get('class_offset'))
-            class_body2 = f2.read(info2.get('class_size'))
-            f2.seek(info2.get('cstring_offset'))
-            cstring_body2 = f2.read(info2.get('cstring_size'))
-            f2.seek(info2.get('methname_offset'))
-            methname_body2 = f2.read(info2.get('methname_size'))
-
-        self.compare_body(class_body1, class_body2, 'classname')
-        self.compare_body(methname_body1, methname_body2, 'methname')
-        self.compare_body(cstring_body1, cstring_body2, 'cstring')
 
-    def compare_body(self, body1, body2, sub_type):
-        """
+def is_macho_head(head):
+    """
+    按文件开头判断是否为 Mach-O, fat 头部还要检查架构数量, 排除同样以 0xcafebabe 开头的 Java class 文件
+    :param head: 文件的前 8 个字节, 可以更长
+    :return:
+    """
+    if len(head) < 8:
+        return False
+    magic = struct.unpack('>I', head[:4])[0]
+    if magic in (MH_MAGIC, MH_MAGIC_64, MH_CIGAM, MH_CIGAM_64):
+        return True
+    if magic in (FAT_MAGIC, FAT_MAGIC_64):
+        return 0 < struct.unpack('>I', head[4:8])[0] <= FAT_MAX_ARCHS
+    if magic in (FAT_CIGAM, FAT_CIGAM_64):
+        return 0 < struct.unpack('<I', head[4:8])[0] <= FAT_MAX_ARCHS
+    return False
 
-        :param body1:
-        :param body2:
-        :param sub_type:
-        :return:
-        """
-        arr1 = body1.split(b'\x00')
-        arr2 = body2.split(b'\x00')
-        total = len(arr1)
-        counter = 0
-        for index, class_name in enumerate(arr1):
-            if class_name:
-                if class_name != arr2[index]:
-                    counter += 1
-        self.text.insert(END, '    {}: 总数量: {}\n'.format(sub_type, total))
-        self.text.insert(END, '    {}: 混淆的数量: {}\n'.format(sub_type, counter))
-        if counter / total < 0.1:
-            self.text.insert(END, '    {}: 百分比: {:.2%}\n'.format(sub_type, counter / total), 'warn')
-        else:
-            self.text.insert(END, '    {}: 百分比: {:.2%}\n'.format(sub_type, counter / total))
 
-        self.text.insert(END, '\n')
+def read_macho_header(file_path):
+    """
+    读取文件头判断是否为 Mach-O, 只读前几个字节, 不依赖 libmagic
+    :param file_path:
+    :return: 不是 Mach-O 时返回 None, 否则返回 ('thin' 或 'fat', cputype 列表)
+    """
+    try:
+        with open(file_path, 'rb') as f:
+            head = f.read(8)
+            if not is_macho_head(head):
+                return None
+            magic = struct.unpack('>I', head[:4])[0]
+            if magic in (MH_MAGIC, MH_MAGIC_64):
+                return 'thin', [struct.unpack('>i', head[4:8])[0]]
+            if magic in (MH_CIGAM, MH_CIGAM_64):
+                return 'thin', [struct.unpack('<i', head[4:8])[0]]
+            endian = '>' if magic in (FAT_MAGIC, FAT_MAGIC_64) else '<'
+            arch_size = 32 if magic in (FAT_MAGIC_64, FAT_CIGAM_64) else 20
+            nfat_arch = struct.unpack(endian + 'I', head[4:8])[0]
+            archs = f.read(nfat_arch * arch_size)
+            if len(archs) < nfat_arch * arch_size:
+                return None
+            return 'fat', [struct.unpack_from(endian + 'i', archs, index * arch_size)[0]
+                           for index in range(nfat_arch)]
+    except OSError:
+        return None
 
 
 def is_macho(file_path):
     """
-
+    只读前 8 个字节判断文件是否为 Mach-O, 不需要架构列表时比 read_macho_header 少读 fat 的架构表
     :param file_path:
     :return:
     """
-    return magic.from_file(file_path, mime=True).find("x-mach-binary") > 0
+    try:
+        with open(file_path, 'rb') as f:
+            return is_macho_head(f.read(8))
+    except OSError:
+        return False
+
+
+def find_macho_files(path):
+    """
+    查找目录下所有 Mach-O 文件, 只读取每个文件的头部
+    :param path: 目录, 例如解压后的 Payload
+    :return: [(文件路径, 'thin' 或 'fat', cputype 列表), ...]
+    """
+    result = list()
+    stack = [path]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    header = read_macho_header(entry.path)
+                    if header:
+                        result.append((entry.path,) + header)
+    return result
 
 
 def random_chars(length=8):
@@ -251,47 +639,869 @@ def random_chars(length=8):
 
 def init_macho_info(macho_file):
     """
-
+    解析 Mach-O 的段信息, 所有偏移都是相对整个文件的偏移(fat 文件已加上切片偏移)
+    同一个二进制在一次比较中会被每个步骤用到, 按路径, 修改时间和大小缓存, 返回的 dict 是共享的, 不能修改
     :param macho_file:
+    :return: __TEXT 中各个节的偏移和长度, 以及符号表, 导出表的位置. 没有 __TEXT 段时返回 None
+    """
+    stat = os.stat(macho_file)
+    return parse_macho_info(os.path.abspath(macho_file), stat.st_mtime_ns, stat.st_size)
+
+
+@functools.lru_cache(maxsize=64)
+def parse_macho_info(macho_file, _mtime_ns, _size):
+    """
+    init_macho_info 的实际解析, 修改时间和大小只用作缓存的键
+    :param macho_file: 绝对路径
+    :param _mtime_ns:
+    :param _size:
     :return:
     """
-    macho_obj = MachO(macho_file)
-    for (_load_cmd, cmd, data) in macho_obj.headers[0].commands:
+    try:
+        from macholib.MachO import MachO
+    except ImportError:
+        print('pip3 install macholib==1.9')
+        sys.exit()
+    with stage("parse"):
+        macho_obj = MachO(macho_file)
+    header = select_macho_header(macho_obj)
+    base = header.offset
+    params = dict()
+    found_text = False
+    params['is_64'] = header.MH_MAGIC in (MH_MAGIC_64, MH_CIGAM_64)
+    params['endian'] = header.endian
+    params['segments'] = list()
+    params['objc_sections'] = dict()
+    for (load_cmd, cmd, data) in header.commands:
+        if load_cmd.cmd == LC_SYMTAB:
+            params['symoff'] = base + cmd.symoff
+            params['nsyms'] = cmd.nsyms
+            params['stroff'] = base + cmd.stroff
+            params['strsize'] = cmd.strsize
+            continue
+        if load_cmd.cmd in (LC_DYLD_INFO, LC_DYLD_INFO_ONLY) and cmd.export_size:
+            params['export_offset'] = base + cmd.export_off
+            params['export_size'] = cmd.export_size
+            continue
+        if load_cmd.cmd == LC_DYLD_EXPORTS_TRIE and cmd.datasize:
+            params['export_offset'] = base + cmd.dataoff
+            params['export_size'] = cmd.datasize
+            continue
+        if load_cmd.cmd == LC_DYLD_CHAINED_FIXUPS and cmd.datasize:
+            params['fixups_offset'] = base + cmd.dataoff
+            params['fixups_size'] = cmd.datasize
+            continue
+        if load_cmd.cmd in (LC_ENCRYPTION_INFO, LC_ENCRYPTION_INFO_64):
+            params['crypt_offset'] = base + cmd.cryptoff
+            params['crypt_size'] = cmd.cryptsize
+            params['crypt_id'] = cmd.cryptid
+            continue
         try:
             segname = getattr(cmd, 'segname')
         except AttributeError:
             continue
-        if segname.startswith(b'__TEXT'):
-            params = dict()
+        if cmd.filesize:
+            params['segments'].append((cmd.vmaddr, cmd.vmsize, base + cmd.fileoff, cmd.filesize,
+                                       segname.rstrip(b'\x00')))
+        if segname.startswith(b'__DATA'):
+            for section in data:
+                sect_name = getattr(section, 'sectname').rstrip(b'\x00')
+                if sect_name in OBJC_LIST_SECTIONS:
+                    params['objc_sections'][sect_name] = (base + section.offset, section.size)
+        if segname.startswith(b'__TEXT') and not found_text:
+            found_text = True
             for _index, section in enumerate(data):
                 sect_name = getattr(section, 'sectname')
                 if sect_name.startswith(b'__text'):
                     text_offset = getattr(section, 'offset')
                     text_size = getattr(section, 'size')
-                    params['text_offset'] = text_offset
+                    params['text_offset'] = base + text_offset
                     params['text_size'] = text_size
                 if sect_name.startswith(b'__objc_classname'):
                     class_offset = getattr(section, 'offset')
                     class_size = getattr(section, 'size')
-                    params['class_offset'] = class_offset
+                    params['class_offset'] = base + class_offset
                     params['class_size'] = class_size
                 if sect_name.startswith(b'__objc_methname'):
                     methname_offset = getattr(section, 'offset')
                     methname_size = getattr(section, 'size')
-                    params['methname_offset'] = methname_offset
+                    params['methname_offset'] = base + methname_offset
                     params['methname_size'] = methname_size
                 if sect_name.startswith(b'__cstring'):
                     cstring_offset = getattr(section, 'offset')
                     cstring_size = getattr(section, 'size')
-                    params['cstring_offset'] = cstring_offset
+                    params['cstring_offset'] = base + cstring_offset
                     params['cstring_size'] = cstring_size
                 if sect_name.startswith(b'__objc_methtype'):
                     methtype_offset = getattr(section, 'offset')
                     methtype_size = getattr(section, 'size')
-                    params['methtype_offset'] = methtype_offset
+                    params['methtype_offset'] = base + methtype_offset
                     params['methtype_size'] = methtype_size
-            return params
-    return None
+    return params if found_text else None
+
+
+def select_macho_header(macho_obj):
+    """
+    fat 文件优先选择 arm64 切片, 否则取第一个
+    :param macho_obj: MachO 对象
+    :return: MachOHeader
+    """
+    for header in macho_obj.headers:
+        if header.header.cputype == CPU_TYPE_ARM64:
+            return header
+    return macho_obj.headers[0]
+
+
+def read_uleb128(view, pos):
+    """
+    读取一个 ULEB128 编码的整数
+    :param view: memoryview
+    :param pos: 起始位置
+    :return: 整数, 下一个字节的位置
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = view[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def parse_export_trie(data):
+    """
+    遍历导出符号 trie, 用显式栈代替递归, 避免很深的 trie 爆栈
+    :param data: 导出表的原始数据
+    :return: 导出符号名列表
+    """
+    view = memoryview(data)
+    names = list()
+    visited = set()
+    stack = [(0, b'')]
+    while stack:
+        node, prefix = stack.pop()
+        if node in visited or node >= len(view):
+            continue
+        visited.add(node)
+        try:
+            terminal_size, pos = read_uleb128(view, node)
+            if terminal_size:
+                names.append(prefix)
+            pos += terminal_size
+            child_count = view[pos]
+            pos += 1
+            for _index in range(child_count):
+                end = data.find(b'\x00', pos)
+                if end < 0:
+                    break
+                label = bytes(view[pos:end])
+                child, pos = read_uleb128(view, end + 1)
+                stack.append((child, prefix + label))
+        except IndexError:
+            # 数据被截断, 跳过这个节点剩下的部分
+            continue
+    return names
+
+
+def read_export_names(macho_file, info):
+    """
+    读取导出表(LC_DYLD_INFO 或 LC_DYLD_EXPORTS_TRIE)中的所有符号名
+    :param macho_file:
+    :param info: init_macho_info 的结果
+    :return: 符号名集合
+    """
+    if not info.get('export_size'):
+        return set()
+    with open(macho_file, 'rb') as f:
+        f.seek(info['export_offset'])
+        data = f.read(info['export_size'])
+    return set(parse_export_trie(data))
+
+
+def read_symbol_names(macho_file, info):
+    """
+    读取符号表中已定义的符号名, 忽略调试符号(stab)和未定义(导入)符号
+    :param macho_file:
+    :param info: init_macho_info 的结果
+    :return: 符号名集合
+    """
+    np = import_numpy()
+    if not info.get('nsyms'):
+        return set()
+    dtype = np.dtype(NLIST_64_FIELDS if info.get('is_64', True) else NLIST_32_FIELDS)
+    if info.get('endian') == '>':
+        dtype = dtype.newbyteorder('>')
+    with open(macho_file, 'rb') as f:
+        f.seek(info['symoff'])
+        entries = np.frombuffer(f.read(info['nsyms'] * dtype.itemsize), dtype=dtype)
+        f.seek(info['stroff'])
+        strtab = f.read(info['strsize'])
+    n_type = entries['n_type']
+    strx = entries['n_strx']
+    mask = ((n_type & N_STAB) == 0) & ((n_type & N_TYPE) != N_UNDF) & (strx > 0) & (strx < len(strtab))
+    strx = strx[mask].astype(np.int64)
+    # 每个名字的结尾是 strx 之后的第一个 \0
+    zeros = np.flatnonzero(np.frombuffer(strtab, dtype=np.uint8) == 0)
+    zeros = np.append(zeros, len(strtab))
+    ends = zeros[np.searchsorted(zeros, strx)]
+    return {strtab[start:end] for start, end in zip(strx.tolist(), ends.tolist())}
+
+
+def diff_name_sets(names1, names2, sample=10):
+    """
+    通过集合比较两组符号名
+    :param names1: 原始二进制的名字集合
+    :param names2: 混淆二进制的名字集合
+    :param sample: 返回的保留名字样例数
+    :return: dict, total 为原始数量, survived 为混淆后仍然存在的数量, samples 为样例
+    """
+    survived = names1 & names2
+    return {
+        'total': len(names1),
+        'total2': len(names2),
+        'survived': len(survived),
+        'samples': heapq.nsmallest(sample, survived),
+    }
+
+
+class ObjcImage:
+    """
+    用 mmap 映射整个二进制, 按虚拟地址读取 objc 元数据
+    只支持 64 位小端(arm64/arm64e)
+    """
+
+    def __init__(self, macho_file, info):
+        self.info = info
+        self.file = open(macho_file, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.segments = sorted(seg[:4] for seg in info.get('segments', ()))
+        self.starts = [seg[0] for seg in self.segments]
+        self.vm_base = min((seg[0] for seg in info.get('segments', ()) if seg[4] != b'__PAGEZERO'), default=0)
+        self.pointer_format = self.read_pointer_format()
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_args):
+        self.close()
+
+    def read_pointer_format(self):
+        """
+        从 LC_DYLD_CHAINED_FIXUPS 中取第一个段的指针格式, 没有 chained fixups 时返回 None
+        :return:
+        """
+        offset = self.info.get('fixups_offset')
+        if not offset:
+            return None
+        try:
+            starts_offset = struct.unpack_from('<I', self.mm, offset + 4)[0]
+            seg_count = struct.unpack_from('<I', self.mm, offset + starts_offset)[0]
+            seg_info = struct.unpack_from('<{}I'.format(seg_count), self.mm, offset + starts_offset + 4)
+            for seg_offset in seg_info:
+                if seg_offset:
+                    return struct.unpack_from('<H', self.mm, offset + starts_offset + seg_offset + 6)[0]
+        except struct.error:
+            pass
+        return None
+
+    def vm_to_offset(self, addr):
+        """
+        虚拟地址转文件偏移
+        :param addr:
+        :return: 不在任何段的文件内容中时返回 None
+        """
+        index = bisect.bisect_right(self.starts, addr) - 1
+        if index < 0:
+            return None
+        vmaddr, _vmsize, fileoff, filesize = self.segments[index]
+        if addr - vmaddr >= filesize:
+            return None
+        return fileoff + addr - vmaddr
+
+    def decode_pointer(self, raw):
+        """
+        还原磁盘上的指针, 处理 chained fixups 和 arm64e 指针认证位
+        bind(指向外部符号)的指针无法在本文件内解析, 返回 None
+        :param raw: 磁盘上的 64 位值
+        :return: 虚拟地址或 None
+        """
+        fmt = self.pointer_format
+        if not raw:
+            return None
+        if fmt is None:
+            return raw
+        if fmt in (DYLD_CHAINED_PTR_ARM64E, DYLD_CHAINED_PTR_ARM64E_USERLAND, DYLD_CHAINED_PTR_ARM64E_USERLAND24):
+            if raw & (1 << 62):
+                return None
+            if raw & (1 << 63):
+                return self.vm_base + (raw & 0xFFFFFFFF)
+            target = raw & 0x7FFFFFFFFFF
+            return target if fmt == DYLD_CHAINED_PTR_ARM64E else self.vm_base + target
+        if fmt in (DYLD_CHAINED_PTR_64, DYLD_CHAINED_PTR_64_OFFSET):
+            if raw & (1 << 63):
+                return None
+            target = raw & 0xFFFFFFFFF
+            return target if fmt == DYLD_CHAINED_PTR_64 else self.vm_base + target
+        return raw
+
+    def read_u32(self, addr):
+        offset = self.vm_to_offset(addr)
+        if offset is None or offset + 4 > len(self.mm):
+            return None
+        return struct.unpack_from('<I', self.mm, offset)[0]
+
+    def read_pointer(self, addr):
+        """
+        读取虚拟地址处的指针并还原
+        :param addr:
+        :return: 虚拟地址或 None
+        """
+        offset = self.vm_to_offset(addr)
+        if offset is None or offset + 8 > len(self.mm):
+            return None
+        return self.decode_pointer(struct.unpack_from('<Q', self.mm, offset)[0])
+
+    def read_cstring(self, addr):
+        """
+        读取虚拟地址处的 C 字符串
+        :param addr:
+        :return: bytes 或 None
+        """
+        if addr is None:
+            return None
+        offset = self.vm_to_offset(addr)
+        if offset is None:
+            return None
+        end = self.mm.find(b'\x00', offset, offset + 0x10000)
+        if end < 0:
+            return None
+        return self.mm[offset:end]
+
+    def iter_list_section(self, sect_name):
+        """
+        遍历 __objc_classlist 之类的指针数组节
+        :param sect_name:
+        :return: 生成还原后的指针
+        """
+        offset, size = self.info.get('objc_sections', {}).get(sect_name, (0, 0))
+        for pos in range(offset, offset + size - size % 8, 8):
+            pointer = self.decode_pointer(struct.unpack_from('<Q', self.mm, pos)[0])
+            if pointer is not None:
+                yield pointer
+
+    def read_method_names(self, addr, names):
+        """
+        读取 method_list_t 中的方法名, 支持相对方法列表
+        :param addr: method_list_t 地址
+        :param names: 结果集合
+        :return:
+        """
+        if not addr:
+            return
+        flags = self.read_u32(addr)
+        method_count = self.read_u32(addr + 4)
+        if flags is None or method_count is None or method_count > OBJC_MAX_COUNT:
+            return
+        entsize = flags & 0xFFFC
+        if not entsize:
+            return
+        for index in range(method_count):
+            entry = addr + 8 + index * entsize
+            if flags & 0x80000000:
+                # 相对方法列表: name 是到 selref 的 int32 相对偏移
+                rel = self.read_u32(entry)
+                if rel is None:
+                    continue
+                rel -= (rel & 0x80000000) << 1
+                name = self.read_cstring(self.read_pointer(entry + rel))
+            else:
+                name = self.read_cstring(self.read_pointer(entry))
+            if name:
+                names.add(name)
+
+    def read_protocol(self, addr, result, visited):
+        """
+        读取 protocol_t 的名字和方法, 以及它继承的协议
+        :param addr:
+        :param result: read_objc_names 的结果
+        :param visited: 已处理的协议地址
+        :return:
+        """
+        stack = [addr]
+        while stack:
+            addr = stack.pop()
+            if addr is None or addr in visited:
+                continue
+            visited.add(addr)
+            name = self.read_cstring(self.read_pointer(addr + 8))
+            if name:
+                result['protocols'].add(name)
+            for field in (24, 32, 40, 48):
+                self.read_method_names(self.read_pointer(addr + field), result['methods'])
+            stack.extend(self.read_protocol_list(self.read_pointer(addr + 16)))
+
+    def read_protocol_list(self, addr):
+        """
+        读取 protocol_list_t
+        :param addr:
+        :return: 协议地址列表
+        """
+        if not addr:
+            return []
+        offset = self.vm_to_offset(addr)
+        if offset is None or offset + 8 > len(self.mm):
+            return []
+        protocol_count = struct.unpack_from('<Q', self.mm, offset)[0]
+        if protocol_count > OBJC_MAX_COUNT:
+            return []
+        return [self.read_pointer(addr + 8 + index * 8) for index in range(protocol_count)]
+
+    def read_class(self, addr, result, visited_protocols):
+        """
+        读取类和它的元类: 类名, 实例方法, 类方法, 遵守的协议
+        :param addr: class_t 地址
+        :param result: read_objc_names 的结果
+        :param visited_protocols: 已处理的协议地址
+        :return:
+        """
+        for cls in (addr, self.read_pointer(addr)):
+            if cls is None:
+                continue
+            data = self.read_pointer(cls + 32)
+            if not data:
+                continue
+            ro = data & ~7
+            name = self.read_cstring(self.read_pointer(ro + 24))
+            if name:
+                result['classes'].add(name)
+            self.read_method_names(self.read_pointer(ro + 32), result['methods'])
+            for protocol in self.read_protocol_list(self.read_pointer(ro + 40)):
+                self.read_protocol(protocol, result, visited_protocols)
+
+
+def read_objc_names(macho_file, info):
+    """
+    遍历 objc 元数据, 收集运行时可见的名字
+    :param macho_file:
+    :param info: init_macho_info 的结果
+    :return: {'classes', 'methods', 'selrefs', 'protocols'} 对应的名字集合
+    """
+    result = {sub_type: set() for sub_type in OBJC_NAME_TYPES}
+    if not info or not info.get('is_64') or info.get('endian') != '<':
+        return result
+    visited_protocols = set()
+    with ObjcImage(macho_file, info) as image:
+        for cls in image.iter_list_section(b'__objc_classlist'):
+            image.read_class(cls, result, visited_protocols)
+        for category in image.iter_list_section(b'__objc_catlist'):
+            for field in (16, 24):
+                image.read_method_names(image.read_pointer(category + field), result['methods'])
+            for protocol in image.read_protocol_list(image.read_pointer(category + 32)):
+                image.read_protocol(protocol, result, visited_protocols)
+        for protocol in image.iter_list_section(b'__objc_protolist'):
+            image.read_protocol(protocol, result, visited_protocols)
+        for selector in image.iter_list_section(b'__objc_selrefs'):
+            name = image.read_cstring(selector)
+            if name:
+                result['selrefs'].add(name)
+    return result
+
+
+def read_window(f, view):
+    """
+    用 readinto 填满缓冲区, 处理短读
+    :param f: 以二进制无缓冲方式打开的文件
+    :param view: 要填充的 memoryview
+    :return: 实际读取的字节数, 小于 len(view) 说明到了文件末尾
+    """
+    filled = 0
+    while filled < len(view):
+        n = f.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+    return filled
+
+
+def iter_section_windows(path1, offset1, path2, offset2, size, window_size=DIFF_WINDOW_SIZE):
+    """
+    按固定大小的窗口同时读取两个文件中的一段区域
+    两个缓冲区在整个过程中复用, 内存占用与段的大小无关
+    :param path1: 文件1
+    :param offset1: 文件1 中区域的起始偏移
+    :param path2: 文件2
+    :param offset2: 文件2 中区域的起始偏移
+    :param size: 区域长度
+    :param window_size: 窗口大小, 会向下对齐到 4 字节
+    :return: 生成 (窗口在区域内的偏移, 窗口1, 窗口2), 窗口是缓冲区的 memoryview, 下一次迭代会被覆盖
+    """
+    window_size = max(4, window_size - window_size % 4)
+    view1 = memoryview(bytearray(window_size))
+    view2 = memoryview(bytearray(window_size))
+    with open(path1, 'rb', buffering=0) as f1, open(path2, 'rb', buffering=0) as f2:
+        f1.seek(offset1)
+        f2.seek(offset2)
+        pos = 0
+        while pos < size:
+            want = min(window_size, size - pos)
+            got = min(read_window(f1, view1[:want]), read_window(f2, view2[:want]))
+            if not got:
+                break
+            yield pos, view1[:got], view2[:got]
+            if got < want:
+                break
+            pos += got
+
+
+def diff_machine_code(path1, info1, path2, info2, window_size=DIFF_WINDOW_SIZE, classify=False,
+                      exclude_address=False):
+    """
+    流式比较两个二进制的 __text 段, 每个窗口只读一次, 需要时同时按指令分类统计
+    长度不同时只统计公共前缀部分
+    :param path1: 原始二进制
+    :param info1: init_macho_info 的结果
+    :param path2: 混淆二进制
+    :param info2: init_macho_info 的结果
+    :param window_size: 窗口大小
+    :param classify: 是否按指令分类统计, 结果在 'classes' 中, 格式与 instruction_class_histogram 相同
+    :param exclude_address: 分类统计时只有地址立即数不同的指令是否不计入变更
+    :return: dict, 包括两个段的长度, 总指令数, 变更的指令数, 以及每个窗口的 (偏移, 指令数, 变更数)
+    """
+    np = import_numpy()
+    size1 = info1.get('text_size', 0)
+    size2 = info2.get('text_size', 0)
+    result = {'size1': size1, 'size2': size2, 'words': 0, 'changed': 0, 'windows': []}
+    class_total = np.zeros(len(INSN_CLASSES), dtype=np.int64)
+    class_changed = np.zeros(len(INSN_CLASSES), dtype=np.int64)
+    address_only = 0
+    for pos, view1, view2 in iter_section_windows(path1, info1.get('text_offset', 0),
+                                                  path2, info2.get('text_offset', 0),
+                                                  min(size1, size2), window_size):
+        words = len(view1) // 4
+        words1 = np.frombuffer(view1, dtype='<u4', count=words)
+        words2 = np.frombuffer(view2, dtype='<u4', count=words)
+        changed_mask = words1 != words2
+        changed = int(np.count_nonzero(changed_mask))
+        result['words'] += words
+        result['changed'] += changed
+        result['windows'].append((pos, words, changed))
+        if not classify:
+            continue
+        classes = classify_instructions(words1)
+        class_total += np.bincount(classes, minlength=len(INSN_CLASSES))
+        address_mask = address_only_changes(words1, words2)
+        address_only += int(np.count_nonzero(address_mask))
+        if exclude_address:
+            changed_mask &= ~address_mask
+        class_changed += np.bincount(classes[changed_mask], minlength=len(INSN_CLASSES))
+    if classify:
+        result['classes'] = {
+            'total': dict(zip(INSN_CLASSES, class_total.tolist())),
+            'changed': dict(zip(INSN_CLASSES, class_changed.tolist())),
+            'address_only': address_only,
+        }
+    return result
+
+
+def classify_instructions(words):
+    """
+    按 arm64 顶层编码给每条指令分类
+    :param words: uint32 指令数组
+    :return: 与 words 等长的分类下标数组, 下标对应 INSN_CLASSES
+    """
+    np = import_numpy()
+    classes = np.array(OP0_CLASS_TABLE, dtype=np.uint8)[(words >> 25) & 0xF]
+    classes[(words & 0x1F000000) == 0x10000000] = ADR_CLASS
+    return classes
+
+
+def address_only_changes(words1, words2):
+    """
+    找出只有地址立即数不同的指令, 通常是函数布局变化导致的, 不算真正的混淆
+    ADR/ADRP 的页地址, ADD/SUB(立即数) 的 imm12, B/BL 的 imm26
+    :param words1: 原始指令数组
+    :param words2: 混淆指令数组
+    :return: bool 数组
+    """
+    np = import_numpy()
+    diff = words1 ^ words2
+    adr = ((words1 & 0x1F000000) == 0x10000000) & ((diff & np.uint32(0x9F00001F)) == 0)
+    add = ((words1 & 0x1F000000) == 0x11000000) & ((diff & np.uint32(0xFFC003FF)) == 0)
+    branch = ((words1 & 0x7C000000) == 0x14000000) & ((diff & np.uint32(0xFC000000)) == 0)
+    return (diff != 0) & (adr | add | branch)
+
+
+def normalize_address_immediates(words):
+    """
+    清除 ADR/ADRP 的页地址, ADD/SUB(立即数) 的 imm12, B/BL 的 imm26, 与 address_only_changes 使用相同的掩码
+    :param words: uint32 指令数组
+    :return: 新的数组
+    """
+    np = import_numpy()
+    group = words & np.uint32(0x1F000000)
+    mask = np.where(group == 0x10000000, np.uint32(0x9F00001F),
+                    np.where(group == 0x11000000, np.uint32(0xFFC003FF), np.uint32(0xFFFFFFFF)))
+    mask[(words & 0x7C000000) == 0x14000000] = 0xFC000000
+    return words & mask
+
+
+def chunk_candidates(words, hash_window=CHUNK_HASH_WINDOW, avg_words=CHUNK_AVG_WORDS):
+    """
+    滚动哈希找出候选块边界
+    每条指令先混合成 64 位, 窗口和用 cumsum 相减得到, 整个过程没有 Python 循环
+    :param words: uint32 指令数组
+    :param hash_window: 滚动哈希窗口(指令数)
+    :param avg_words: 平均块长度, 必须是 2 的幂
+    :return: 候选边界(块结束位置, 不包含)数组, 只包含窗口完整的位置
+    """
+    np = import_numpy()
+    if len(words) < hash_window:
+        return np.zeros(0, dtype=np.int64)
+    gear = words.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    gear ^= gear >> np.uint64(29)
+    sums = np.cumsum(gear, dtype=np.uint64)
+    rolling = sums[hash_window - 1:].copy()
+    rolling[1:] -= sums[:-hash_window]
+    hits = np.flatnonzero(((rolling >> np.uint64(32)) & np.uint64(avg_words - 1)) == 0)
+    return hits + hash_window
+
+
+def select_chunk_cuts(candidates, length, final, min_words=CHUNK_MIN_WORDS, max_words=CHUNK_MAX_WORDS):
+    """
+    按最小/最大块长度从候选边界中选出块边界, 循环次数与候选数成正比
+    :param candidates: chunk_candidates 的结果
+    :param length: 指令数
+    :param final: 是否是最后一段, 最后一段剩余的部分也作为一块
+    :param min_words: 最小块长度
+    :param max_words: 最大块长度, 超过时强制切分
+    :return: 块边界列表, 最后一个块边界(之后的指令留给下一段)
+    """
+    cuts = list()
+    last = 0
+    for end in candidates.tolist():
+        while end - last > max_words:
+            last += max_words
+            cuts.append(last)
+        if end - last >= min_words:
+            cuts.append(end)
+            last = end
+    while length - last > max_words:
+        last += max_words
+        cuts.append(last)
+    if final and length > last:
+        cuts.append(length)
+        last = length
+    return cuts, last
+
+
+def code_chunk_hashes(path, offset, size, normalize=False, window_size=DIFF_WINDOW_SIZE):
+    """
+    按内容定义分块, 计算每块的哈希
+    按窗口流式读取, 上一个窗口最后一个块边界之后的指令与下一个窗口拼接, 分块结果与窗口大小无关
+    :param path: 二进制
+    :param offset: __text 偏移
+    :param size: __text 长度
+    :param normalize: 是否先清除地址立即数
+    :param window_size: 窗口大小
+    :return: 块哈希(uint64)数组, 块长度(字节)数组
+    """
+    np = import_numpy()
+    window_size = max(4, window_size - window_size % 4)
+    view = memoryview(bytearray(window_size))
+    carry = np.zeros(0, dtype=np.uint32)
+    digests = list()
+    lengths = list()
+    size -= size % 4
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(offset)
+        pos = 0
+        while pos < size:
+            want = min(window_size, size - pos)
+            got = read_window(f, view[:want])
+            got -= got % 4
+            pos += got
+            final = not got or got < want or pos >= size
+            words = np.frombuffer(view[:got], dtype='<u4')
+            if normalize:
+                words = normalize_address_immediates(words)
+            words = np.concatenate((carry, words))
+            cuts, last = select_chunk_cuts(chunk_candidates(words), len(words), final)
+            data = memoryview(words.astype('<u4', copy=False)).cast('B')
+            start = 0
+            for end in cuts:
+                digests.append(hashlib.blake2b(data[start * 4:end * 4], digest_size=8).digest())
+                start = end
+            lengths.append(np.diff(cuts, prepend=0) * 4)
+            carry = words[last:].copy()
+            if final:
+                break
+    lengths = np.concatenate(lengths).astype(np.int64) if lengths else np.zeros(0, dtype=np.int64)
+    return np.frombuffer(b''.join(digests), dtype='<u8'), lengths
+
+
+def minhash_signature(hashes, num_perm=MINHASH_PERMUTATIONS, seed=1):
+    """
+    块哈希集合的 MinHash 签名, 两个签名相同位置相等的比例是集合 Jaccard 相似度的估计
+    :param hashes: 块哈希数组
+    :param num_perm: 签名长度
+    :param seed: 随机种子, 比较的签名必须使用相同的种子
+    :return: uint64 数组
+    """
+    np = import_numpy()
+    unique = np.unique(hashes)
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(1, 1 << 63, num_perm, dtype=np.uint64) | np.uint64(1)
+    increments = rng.integers(0, 1 << 63, num_perm, dtype=np.uint64)
+    signature = np.full(num_perm, np.iinfo(np.uint64).max, dtype=np.uint64)
+    if not unique.size:
+        return signature
+    for index in range(num_perm):
+        permuted = unique * multipliers[index] + increments[index]
+        permuted ^= permuted >> np.uint64(31)
+        signature[index] = permuted.min()
+    return signature
+
+
+def minhash_similarity(signature1, signature2):
+    np = import_numpy()
+    return float(np.count_nonzero(signature1 == signature2)) / len(signature1)
+
+
+def code_similarity(path1, info1, path2, info2, normalize=False):
+    """
+    比较两个 __text 的内容定义分块
+    :param path1: 原始二进制
+    :param info1: init_macho_info 的结果
+    :param path2: 混淆二进制
+    :param info2: init_macho_info 的结果
+    :param normalize: 是否先清除地址立即数
+    :return: dict, verbatim_bytes 为混淆二进制中在原始二进制任意位置出现过的块的总长度
+    """
+    np = import_numpy()
+    hashes1, _lengths1 = code_chunk_hashes(path1, info1.get('text_offset', 0), info1.get('text_size', 0), normalize)
+    hashes2, lengths2 = code_chunk_hashes(path2, info2.get('text_offset', 0), info2.get('text_size', 0), normalize)
+    unique1 = np.unique(hashes1)
+    unique2 = np.unique(hashes2)
+    union = len(np.union1d(unique1, unique2))
+    return {
+        'chunks1': len(hashes1),
+        'chunks2': len(hashes2),
+        'bytes2': int(lengths2.sum()),
+        'verbatim_bytes': int(lengths2[np.isin(hashes2, unique1)].sum()),
+        'jaccard': len(np.intersect1d(unique1, unique2, assume_unique=True)) / union if union else 0.0,
+        'minhash_jaccard': minhash_similarity(minhash_signature(hashes1), minhash_signature(hashes2)),
+    }
+
+
+def instruction_class_histogram(path1, info1, path2, info2, exclude_address=False, window_size=DIFF_WINDOW_SIZE):
+    """
+    按指令分类统计两个 __text 段(公共部分)的变更数
+    :param path1: 原始二进制
+    :param info1: init_macho_info 的结果
+    :param path2: 混淆二进制
+    :param info2: init_macho_info 的结果
+    :param exclude_address: 只有地址立即数不同的指令是否不计入变更
+    :param window_size: 窗口大小
+    :return: dict, total/changed 为 {分类名: 数量}, address_only 为只有地址变更的指令数
+    """
+    return diff_machine_code(path1, info1, path2, info2, window_size, True, exclude_address)['classes']
+
+
+def entropy_windows(path, offset, size, window_size=ENTROPY_WINDOW_SIZE, read_size=DIFF_WINDOW_SIZE):
+    """
+    按固定窗口计算一段区域的字节熵
+    每次读入 read_size 字节, 用 bincount(窗口下标 * 256 + 字节) 一次统计所有窗口的字节频率
+    :param path: 文件
+    :param offset: 区域起始偏移
+    :param size: 区域长度
+    :param window_size: 窗口大小
+    :param read_size: 每次读取的大小, 会向下对齐到窗口大小
+    :return: 每个窗口的熵(bits/byte), 最后一个窗口可能不足 window_size
+    """
+    np = import_numpy()
+    read_size = max(window_size, read_size - read_size % window_size)
+    view = memoryview(bytearray(read_size))
+    # 每个字节所在窗口的 bincount 起点, 所有块共用
+    bins = np.repeat(np.arange(read_size // window_size, dtype=np.int32) * 256, window_size)
+    result = list()
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(offset)
+        pos = 0
+        while pos < size:
+            want = min(read_size, size - pos)
+            got = read_window(f, view[:want])
+            if not got:
+                break
+            data = np.frombuffer(view[:got], dtype=np.uint8)
+            windows = (got + window_size - 1) // window_size
+            counts = np.bincount(bins[:got] + data, minlength=windows * 256).reshape(windows, 256)
+            lengths = np.full(windows, window_size, dtype=np.float64)
+            lengths[-1] = got - (windows - 1) * window_size
+            p = counts / lengths[:, None]
+            result.append(-(p * np.log2(np.where(counts, p, 1))).sum(axis=1))
+            if got < want:
+                break
+            pos += got
+    return np.concatenate(result) if result else np.zeros(0)
+
+
+def high_entropy_ranges(entropies, window_size=ENTROPY_WINDOW_SIZE, threshold=ENTROPY_THRESHOLD):
+    """
+    合并连续的高熵窗口
+    :param entropies: entropy_windows 的结果
+    :param window_size:
+    :param threshold: 熵阈值
+    :return: [(起始偏移, 结束偏移), ...], 偏移相对区域起点
+    """
+    np = import_numpy()
+    mask = np.concatenate(([False], entropies > threshold, [False]))
+    edges = np.flatnonzero(mask[1:] != mask[:-1])
+    return [(int(start) * window_size, int(end) * window_size) for start, end in zip(edges[::2], edges[1::2])]
+
+
+def scan_section_entropy(path, info, window_size=ENTROPY_WINDOW_SIZE, threshold=ENTROPY_THRESHOLD):
+    """
+    扫描 __TEXT 中各节的熵, 在比较之前找出加壳或加密的区域
+    :param path: 二进制
+    :param info: init_macho_info 的结果
+    :param window_size:
+    :param threshold:
+    :return: {节名: (窗口数, 高熵区域列表)}, 区域偏移是文件偏移
+    """
+    result = dict()
+    for sect_name, key in ENTROPY_SECTIONS:
+        size = info.get(key + '_size', 0)
+        if not size:
+            continue
+        offset = info[key + '_offset']
+        entropies = entropy_windows(path, offset, size, window_size)
+        ranges = [(offset + start, offset + min(end, size))
+                  for start, end in high_entropy_ranges(entropies, window_size, threshold)]
+        result[sect_name] = (len(entropies), ranges)
+    return result
+
+
+def format_density_map(windows, width=64):
+    """
+    把每个窗口的变更比例画成字符图, 每个字符代表一个窗口
+    :param windows: diff_machine_code 返回的窗口列表
+    :param width: 每行字符数
+    :return: 行列表, 每行以该行第一个窗口的偏移开头
+    """
+    lines = list()
+    scale = len(DENSITY_CHARS) - 1
+    for start in range(0, len(windows), width):
+        row = windows[start:start + width]
+        chars = ''.join(DENSITY_CHARS[max(1, int(round(changed / words * scale))) if changed else 0]
+                        for _pos, words, changed in row)
+        lines.append('0x{:08x} |{}|'.format(row[0][0], chars))
+    return lines
 
 
 def namelist(path):
@@ -318,13 +1528,13 @@ def find_main_and_framework(path):
     file_list = namelist(path)
     for d in file_list:
         if os.path.isdir(d) and d.endswith('.app'):
-            print(d)
-            main_path = os.path.join(d, d.split('/')[-1].strip('.app'))
-            print(main_path)
+            main_path = os.path.join(d, d.split('/')[-1][:-len('.app')])
         if os.path.isdir(d) and d.endswith('.app/Frameworks'):
             frameworks_home = d
     if not main_path:
         return None, None
+    if not frameworks_home:
+        return main_path, frameworks_list
     listdir = os.listdir(frameworks_home)
     for _d in listdir:
         _path = os.path.join(frameworks_home, _d)
@@ -347,14 +1557,15 @@ def decompression(ipa_file_path):
         shutil.rmtree(tmp_dir)
 
     # popen_command(['unzip', ipa_file_path, '-d', tmp_dir])
-    ipa_file = zipfile.ZipFile(ipa_file_path, 'r')
-    for file in ipa_file.namelist():
-        try:
-            if file.startswith('__MACOSX'):
-                continue
-            ipa_file.extract(file, tmp_dir)
-        except UnicodeEncodeError:
-            print(file)
+    with stage("unzip", ipa=os.path.basename(ipa_file_path)):
+        ipa_file = zipfile.ZipFile(ipa_file_path, 'r')
+        for file in ipa_file.namelist():
+            try:
+                if file.startswith('__MACOSX'):
+                    continue
+                ipa_file.extract(file, tmp_dir)
+            except UnicodeEncodeError:
+                print('无法解压:', file, file=sys.stderr)
     return tmp_dir
 
 
@@ -366,4 +1577,57 @@ def center_window(root, width, height):
     root.geometry(size)
 
 
-CompareApplication()
+def usage():
+    print("Use:python3 compare.py                            打开界面")
+    print("    python3 compare.py -a origin.ipa -b new.ipa    无界面比较, --keep-address 不排除地址变更")
+    print("                                                   --similarity 按内容分块比较机器码")
+    print("                                                   有二进制已加密或加壳时退出码为 2")
+    print("    python3 compare.py -l dir                      列出目录下的 Mach-O 文件")
+    print("环境变量 PIPELINE_TRACE=trace.json 统计各阶段耗时, PIPELINE_PROFILE=out.prof 打开 cProfile")
+
+
+if __name__ == "__main__":
+    enable_from_env()
+    try:
+        opts_list, _ = getopt.getopt(sys.argv[1:],
+                                     "ha:b:l:",
+                                     ["help", "origin=", "obfuscated=", "list=", "keep-address", "similarity"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    origin_ipa = None
+    obfuscated_ipa = None
+    list_dir = None
+    exclude_address_changes = True
+    chunk_similarity = False
+    for o, a in opts_list:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(1)
+        if o in ("-a", "--origin"):
+            origin_ipa = a
+        if o in ("-b", "--obfuscated"):
+            obfuscated_ipa = a
+        if o in ("-l", "--list"):
+            list_dir = a
+        if o == "--keep-address":
+            exclude_address_changes = False
+        if o == "--similarity":
+            chunk_similarity = True
+
+    if list_dir:
+        for macho_path, macho_kind, cpu_types in find_macho_files(list_dir):
+            print(macho_path, macho_kind, ','.join('0x{:x}'.format(c & 0xffffffff) for c in cpu_types))
+    elif origin_ipa or obfuscated_ipa:
+        if not origin_ipa or not obfuscated_ipa or not os.path.isfile(origin_ipa) \
+                or not os.path.isfile(obfuscated_ipa):
+            usage()
+            sys.exit(1)
+        comparer = MachOComparer(ConsoleText(), exclude_address_changes, chunk_similarity)
+        comparer.compare_ipa(origin_ipa, obfuscated_ipa)
+        if comparer.skipped:
+            # 有二进制因为加密或加壳没有比较, 返回非 0, 方便脚本发现
+            sys.exit(2)
+    else:
+        CompareApplication()
@@ -0,0 +1,312 @@
+"""
+已发布版本的指纹索引, 查询新 ipa 与哪些旧版本有相同的内容
+
+指纹分三类, 都是 64 位哈希, 保存在 SQLite 中:
+1.resource 资源文件, 直接用 zip 中记录的 crc32 和大小, 不需要解压
+2.code     主二进制和库二进制 __text 的内容定义分块哈希(compare.code_chunk_hashes, 已清除地址立即数)
+3.string   __cstring, __objc_classname, __objc_methname 中的字符串哈希, 太短的字符串各个 app 都有, 不记录
+
+每个版本只需要导入一次, 查询时把新 ipa 的指纹放进临时表, 与索引做一次 join, 几千个版本也在一秒内返回
+
+Use:python3 fingerprint_index.py [-d fingerprints.sqlite] --add build.ipa [--name 1.0.3]
+    python3 fingerprint_index.py [-d fingerprints.sqlite] --query new.ipa [--top 20]
+    python3 fingerprint_index.py [-d fingerprints.sqlite] --list
+"""
+
+import getopt
+import hashlib
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import time
+import zipfile
+
+import compare
+from pipeline_trace import stage, count, enable_from_env
+
+DEFAULT_INDEX_PATH = 'fingerprints.sqlite'
+KIND_RESOURCE = 1
+KIND_CODE = 2
+KIND_STRING = 3
+KIND_NAMES = {KIND_RESOURCE: 'resource', KIND_CODE: 'code', KIND_STRING: 'string'}
+# 短于这个长度的字符串不记录
+MIN_STRING_LENGTH = 8
+STRING_SECTIONS = ('cstring', 'class', 'methname')
+# 资源中不记录的目录, 每次签名都会变化
+SKIP_RESOURCE_DIRS = ('_CodeSignature/', 'SC_Info/')
+INSERT_BATCH_SIZE = 50000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    ipa TEXT,
+    added REAL,
+    resource INTEGER NOT NULL DEFAULT 0,
+    code INTEGER NOT NULL DEFAULT 0,
+    string INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    kind INTEGER NOT NULL,
+    hash INTEGER NOT NULL,
+    build_id INTEGER NOT NULL,
+    PRIMARY KEY (kind, hash, build_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS fingerprints_build ON fingerprints (build_id);
+"""
+
+
+def open_index(index_path):
+    """
+    打开(或创建)索引
+    :param index_path: SQLite 文件路径
+    :return: sqlite3.Connection
+    """
+    conn = sqlite3.connect(index_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def signed64(value):
+    """
+    SQLite 的整数是有符号 64 位
+    :param value: 无符号 64 位整数
+    :return:
+    """
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def hash_bytes(data):
+    return struct.unpack('<q', hashlib.blake2b(data, digest_size=8).digest())[0]
+
+
+def is_macho_member(zin, zinfo):
+    """
+    读成员的前 8 个字节判断是否为 Mach-O
+    :param zin:
+    :param zinfo:
+    :return:
+    """
+    if zinfo.file_size < 4096:
+        return False
+    with zin.open(zinfo) as f:
+        return compare.is_macho_head(f.read(8))
+
+
+def resource_fingerprints(zin):
+    """
+    资源指纹, crc32 和大小直接从 zip 目录中读取
+    :param zin: ipa
+    :return: set
+    """
+    result = set()
+    for zinfo in zin.infolist():
+        if zinfo.is_dir() or not zinfo.file_size or zinfo.filename.startswith('__MACOSX'):
+            continue
+        if any(skip in zinfo.filename for skip in SKIP_RESOURCE_DIRS):
+            continue
+        result.add(signed64(((zinfo.CRC << 32) ^ zinfo.file_size) & 0xFFFFFFFFFFFFFFFF))
+    return result
+
+
+def binary_fingerprints(binary_path):
+    """
+    一个二进制的代码块和字符串指纹
+    :param binary_path:
+    :return: 代码块哈希 set, 字符串哈希 set
+    """
+    info = compare.init_macho_info(binary_path)
+    if info is None:
+        return set(), set()
+    if info.get('crypt_id'):
+        print('%s 已加密, 只记录资源指纹' % os.path.basename(binary_path))
+        return set(), set()
+    np = compare.import_numpy()
+    hashes, _lengths = compare.code_chunk_hashes(binary_path, info.get('text_offset', 0), info.get('text_size', 0),
+                                                 True)
+    code = set(np.unique(hashes).view(np.int64).tolist())
+    strings = set()
+    with open(binary_path, 'rb') as f:
+        for key in STRING_SECTIONS:
+            size = info.get(key + '_size', 0)
+            if not size:
+                continue
+            f.seek(info[key + '_offset'])
+            for item in f.read(size).split(b'\x00'):
+                if len(item) >= MIN_STRING_LENGTH:
+                    strings.add(hash_bytes(item))
+    return code, strings
+
+
+def ipa_fingerprints(ipa_path):
+    """
+    计算 ipa 的全部指纹, 只解压 Mach-O 文件
+    :param ipa_path:
+    :return: {kind: set}
+    """
+    result = {KIND_RESOURCE: set(), KIND_CODE: set(), KIND_STRING: set()}
+    work_dir = tempfile.mkdtemp(prefix='fingerprint_')
+    try:
+        with zipfile.ZipFile(ipa_path) as zin:
+            with stage("fingerprint", kind='resource'):
+                result[KIND_RESOURCE] = resource_fingerprints(zin)
+            for zinfo in zin.infolist():
+                if zinfo.is_dir() or not zinfo.filename.startswith('Payload/') or not is_macho_member(zin, zinfo):
+                    continue
+                binary_path = zin.extract(zinfo, work_dir)
+                with stage("fingerprint", kind='binary', binary=os.path.basename(zinfo.filename)):
+                    code, strings = binary_fingerprints(binary_path)
+                result[KIND_CODE] |= code
+                result[KIND_STRING] |= strings
+                os.remove(binary_path)
+    finally:
+        shutil.rmtree(work_dir)
+    return result
+
+
+def add_build(conn, ipa_path, name=None):
+    """
+    导入一个版本, 同名版本会被替换
+    :param conn: open_index 的结果
+    :param ipa_path:
+    :param name: 版本名, 默认为 ipa 文件名
+    :return: {kind 名: 指纹数量}
+    """
+    name = name or os.path.basename(ipa_path)
+    fingerprints = ipa_fingerprints(ipa_path)
+    with stage("ingest"), conn:
+        row = conn.execute('SELECT id FROM builds WHERE name = ?', (name,)).fetchone()
+        if row is not None:
+            conn.execute('DELETE FROM fingerprints WHERE build_id = ?', row)
+            conn.execute('DELETE FROM builds WHERE id = ?', row)
+        build_id = conn.execute(
+            'INSERT INTO builds (name, ipa, added, resource, code, string) VALUES (?, ?, ?, ?, ?, ?)',
+            (name, os.path.abspath(ipa_path), time.time(), len(fingerprints[KIND_RESOURCE]),
+             len(fingerprints[KIND_CODE]), len(fingerprints[KIND_STRING]))).lastrowid
+        for kind, hashes in fingerprints.items():
+            rows = [(kind, value, build_id) for value in hashes]
+            for start in range(0, len(rows), INSERT_BATCH_SIZE):
+                conn.executemany('INSERT OR IGNORE INTO fingerprints (kind, hash, build_id) VALUES (?, ?, ?)',
+                                 rows[start:start + INSERT_BATCH_SIZE])
+            count("fingerprints_" + KIND_NAMES[kind], len(rows))
+    return {KIND_NAMES[kind]: len(hashes) for kind, hashes in fingerprints.items()}
+
+
+def query_fingerprints(conn, fingerprints, top=20):
+    """
+    查询与索引中各个版本重合的指纹数量
+    :param conn: open_index 的结果
+    :param fingerprints: ipa_fingerprints 的结果
+    :param top: 返回重合最多的版本数
+    :return: [{"name", "ipa", "shared": {kind 名: 数量}, "ratio": {kind 名: 占新 ipa 的比例}}, ...]
+    """
+    with stage("query"):
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS query (kind INTEGER NOT NULL, hash INTEGER NOT NULL, '
+                     'PRIMARY KEY (kind, hash)) WITHOUT ROWID')
+        conn.execute('DELETE FROM temp.query')
+        for kind, hashes in fingerprints.items():
+            conn.executemany('INSERT OR IGNORE INTO temp.query (kind, hash) VALUES (?, ?)',
+                             ((kind, value) for value in hashes))
+        # CROSS JOIN 固定连接顺序: 遍历新 ipa 的指纹, 按主键查找索引, 否则 SQLite 可能为了 GROUP BY 扫描整个索引
+        rows = conn.execute(
+            'SELECT f.build_id, f.kind, COUNT(*) FROM temp.query AS q '
+            'CROSS JOIN fingerprints AS f ON f.kind = q.kind AND f.hash = q.hash '
+            'GROUP BY f.build_id, f.kind').fetchall()
+        conn.execute('DELETE FROM temp.query')
+    builds = dict()
+    for build_id, kind, shared in rows:
+        builds.setdefault(build_id, dict())[KIND_NAMES[kind]] = shared
+    totals = {KIND_NAMES[kind]: len(hashes) for kind, hashes in fingerprints.items()}
+    result = list()
+    for build_id, shared in builds.items():
+        name, ipa = conn.execute('SELECT name, ipa FROM builds WHERE id = ?', (build_id,)).fetchone()
+        ratio = {kind: shared.get(kind, 0) / total if total else 0.0 for kind, total in totals.items()}
+        result.append({'name': name, 'ipa': ipa, 'shared': shared, 'ratio': ratio})
+    result.sort(key=lambda item: -sum(item['ratio'].values()))
+    return result[:top]
+
+
+def query_build(conn, ipa_path, top=20):
+    """
+    查询新 ipa 与哪些已导入的版本有相同的内容
+    :param conn: open_index 的结果
+    :param ipa_path:
+    :param top:
+    :return: query_fingerprints 的结果
+    """
+    return query_fingerprints(conn, ipa_fingerprints(ipa_path), top)
+
+
+def list_builds(conn):
+    return conn.execute('SELECT name, ipa, added, resource, code, string FROM builds ORDER BY added').fetchall()
+
+
+def usage():
+    print("Use:python3 fingerprint_index.py [-d fingerprints.sqlite] --add build.ipa [--name 1.0.3]  导入版本")
+    print("    python3 fingerprint_index.py [-d fingerprints.sqlite] --query new.ipa [--top 20]  查询重合的版本")
+    print("    python3 fingerprint_index.py [-d fingerprints.sqlite] --list  列出已导入的版本")
+
+
+if __name__ == "__main__":
+    enable_from_env()
+    try:
+        opts_list, _ = getopt.getopt(sys.argv[1:], "hd:a:q:l", ["help", "db=", "add=", "name=", "query=", "top=",
+                                                                "list"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    index_path = DEFAULT_INDEX_PATH
+    add_ipa = None
+    build_name = None
+    query_ipa = None
+    top_builds = 20
+    show_list = False
+    for o, a in opts_list:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(1)
+        if o in ("-d", "--db"):
+            index_path = a
+        if o in ("-a", "--add"):
+            add_ipa = a
+        if o == "--name":
+            build_name = a
+        if o in ("-q", "--query"):
+            query_ipa = a
+        if o == "--top":
+            top_builds = int(a)
+        if o in ("-l", "--list"):
+            show_list = True
+    if not add_ipa and not query_ipa and not show_list:
+        usage()
+        sys.exit(1)
+
+    index = open_index(index_path)
+    if add_ipa:
+        print(build_name or os.path.basename(add_ipa), add_build(index, add_ipa, build_name))
+    if query_ipa:
+        start_time = time.perf_counter()
+        query_prints = ipa_fingerprints(query_ipa)
+        fingerprint_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        overlaps = query_fingerprints(index, query_prints, top_builds)
+        for overlap in overlaps:
+            print('%-40s %s' % (overlap['name'], '  '.join(
+                '%s: %d (%.2f%%)' % (kind, overlap['shared'].get(kind, 0), overlap['ratio'][kind] * 100)
+                for kind in KIND_NAMES.values())))
+        if not overlaps:
+            print('没有重合的版本')
+        print('计算指纹 %.2fs, 查询 %.3fs' % (fingerprint_seconds, time.perf_counter() - start_time))
+    if show_list:
+        for build in list_builds(index):
+            print('%-40s %s  resource: %d  code: %d  string: %d  %s' % (
+                build[0], time.strftime('%Y-%m-%d %H:%M', time.localtime(build[2])), build[3], build[4], build[5],
+                build[1]))
+    index.close()
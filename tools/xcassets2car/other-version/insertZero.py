@@ -1,23 +1,298 @@
+"""
+在资源文件末尾填充随机个数的 0, 改变资源的哈希
+
+1.process_nib 处理已经解压的目录
+2.repack_ipa 直接读写 ipa, 不需要的成员按压缩后的原始数据复制, 只有需要填充的成员重新压缩,
+  一次写出新的 ipa, 不需要解压和重新压缩整个包
+
+Use:python3 insertZero.py -d payload_dir
+    python3 insertZero.py -i origin.ipa -o padded.ipa [--prefix Payload/] [--seed 1] [-j 8]
+"""
+
+import copy
+import getopt
 import os
 import random
-import binascii
+import shutil
+import struct
+import sys
+import tempfile
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from compare import is_macho, is_macho_head
+from pipeline_trace import stage, count, enable_from_env
+
+# 不填充的文件, plist 和 sqlite 填充后无法解析, _CodeSignature 填充后签名失效
+SKIP_SUFFIXES = ('.sqlite', '.plist')
+SKIP_DIRS = ('_CodeSignature',)
+# 填充 0 的个数为 4 * [PAD_MIN_WORDS, PAD_MAX_WORDS]
+PAD_MIN_WORDS = 2
+PAD_MAX_WORDS = 25
+
+# local file header, 与 zipfile.structFileHeader 相同
+LOCAL_HEADER_FORMAT = '<4s2B4HL2L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+LOCAL_HEADER_MAGIC = b'PK\x03\x04'
+# general purpose bit 3, crc 和大小写在数据后面的 data descriptor 中
+FLAG_DATA_DESCRIPTOR = 0x08
+FLAG_ENCRYPTED = 0x01
+ZIP64_EXTRA_ID = 0x0001
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def should_pad(file_path):
+    """
+    是否需要填充
+    :param file_path: 文件路径或 ipa 中的成员名
+    :return:
+    """
+    lower_path = file_path.lower()
+    if lower_path.endswith(SKIP_SUFFIXES):
+        return False
+    parts = file_path.replace(os.sep, '/').split('/')
+    return not any(part in SKIP_DIRS for part in parts)
+
+
+def padding_size(rng):
+    return rng.randint(PAD_MIN_WORDS, PAD_MAX_WORDS) * 4
+
 
 def process_nib(payload_path):
 
     for root, dirs, files in os.walk(payload_path):
         for file in files:
             file_path = os.path.join(root, file)
-            # print file_path
-            
-            if file_path.lower().endswith('.sqlite'):
-                print 'over sqlite'
-                continue
-            if file_path.lower().endswith('.plist'):
+            # print(file_path)
+
+            # 可执行文件和 framework 的二进制不填充, 末尾多出数据后重签名会失败
+            if not should_pad(file_path) or is_macho(file_path):
                 continue
-            f=open(file_path,"ab")
-            num=random.randint(2,25);
-            for i in range(0,num*4):
-                f.write(binascii.unhexlify('00'))
-            f.close()
+            with open(file_path, "ab") as f:
+                f.write(bytes(padding_size(random)))
+
+
+def strip_zip64_extra(extra):
+    """
+    去掉 extra 中的 zip64 字段, 需要时由 FileHeader 按新的大小重新生成
+    :param extra:
+    :return:
+    """
+    result = bytearray()
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack_from('<HH', extra, offset)
+        if header_id != ZIP64_EXTRA_ID:
+            result += extra[offset:offset + 4 + size]
+        offset += 4 + size
+    return bytes(result)
+
+
+def raw_data_offset(fp, zinfo):
+    """
+    成员压缩数据在 ipa 中的偏移, local header 中的 extra 长度可能与 central directory 不同
+    :param fp: ipa 文件
+    :param zinfo:
+    :return:
+    """
+    fp.seek(zinfo.header_offset)
+    header = struct.unpack(LOCAL_HEADER_FORMAT, fp.read(LOCAL_HEADER_SIZE))
+    if header[0] != LOCAL_HEADER_MAGIC:
+        raise zipfile.BadZipFile('local header 错误: %s' % zinfo.filename)
+    return zinfo.header_offset + LOCAL_HEADER_SIZE + header[10] + header[11]
+
+
+def copy_raw(src_fp, dst_fp, offset, size, buffer):
+    """
+    按块复制原始数据
+    :param src_fp:
+    :param dst_fp:
+    :param offset: 源偏移
+    :param size: 字节数
+    :param buffer: 复用的 bytearray
+    :return:
+    """
+    src_fp.seek(offset)
+    view = memoryview(buffer)
+    while size > 0:
+        read = src_fp.readinto(view[:min(size, len(buffer))])
+        if not read:
+            raise zipfile.BadZipFile('ipa 数据不完整')
+        dst_fp.write(view[:read])
+        size -= read
+
+
+def pad_member(zin, zinfo, padding, level):
+    """
+    流式解压成员, 末尾填充 0 后重新压缩, 在线程池中运行, zlib 压缩时会释放 GIL
+    每次只处理 COPY_BUFFER_SIZE 的数据, 压缩结果写入临时文件, 内存占用与成员大小无关
+    :param zin: 源 ipa
+    :param zinfo:
+    :param padding: 填充字节数
+    :param level: 压缩级别
+    :return: 压缩后数据的临时文件, crc, 原始大小, 压缩后大小, 成员是 Mach-O 时返回 None
+    """
+    deflate = zinfo.compress_type == zipfile.ZIP_DEFLATED
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15) if deflate else None
+    output = tempfile.SpooledTemporaryFile(COPY_BUFFER_SIZE)
+    crc = 0
+    size = 0
+
+    def write(chunk):
+        nonlocal crc, size
+        crc = zlib.crc32(chunk, crc)
+        size += len(chunk)
+        output.write(compressor.compress(chunk) if deflate else chunk)
+
+    try:
+        with zin.open(zinfo) as f:
+            chunk = f.read(COPY_BUFFER_SIZE)
+            # 可执行文件和 framework 的二进制不填充, 末尾多出数据后重签名会失败
+            if is_macho_head(chunk):
+                output.close()
+                return None
+            while chunk:
+                write(chunk)
+                chunk = f.read(COPY_BUFFER_SIZE)
+        write(bytes(padding))
+        if deflate:
+            output.write(compressor.flush())
+    except BaseException:
+        output.close()
+        raise
+    compress_size = output.tell()
+    output.seek(0)
+    return output, crc, size, compress_size
+
+
+def write_member(zout, zinfo, writer):
+    """
+    写入一个成员的 local header 和数据, 并记录到 central directory
+    :param zout: 输出 ipa
+    :param zinfo: 已经更新好 crc 和大小的 ZipInfo
+    :param writer: 写数据的函数
+    :return:
+    """
+    zinfo.flag_bits &= ~FLAG_DATA_DESCRIPTOR
+    zinfo.extra = strip_zip64_extra(zinfo.extra)
+    zinfo.header_offset = zout.fp.tell()
+    zout.fp.write(zinfo.FileHeader())
+    writer()
+    # 与 ZipFile.write 相同, 记录到 filelist 和 NameToInfo 后由 close() 写出 central directory
+    zout.filelist.append(zinfo)
+    zout.NameToInfo[zinfo.filename] = zinfo
+
+
+def repack_ipa(src_ipa, dst_ipa, prefix='Payload/', seed=None, max_workers=None, level=6):
+    """
+    流式填充 ipa 中的资源
+    不需要填充的成员直接复制压缩后的数据, 需要填充的成员在线程池中解压, 填充, 重新压缩, 按原顺序写出
+    :param src_ipa: 源 ipa
+    :param dst_ipa: 输出 ipa
+    :param prefix: 只填充以此开头的成员
+    :param seed: 随机种子, 相同种子的输出相同
+    :param max_workers: 压缩线程数
+    :param level: 压缩级别
+    :return: 统计 {'members', 'padded', 'copied_bytes', 'padded_bytes'}
+    """
+    rng = random.Random(seed)
+    max_workers = max_workers or os.cpu_count() or 1
+    stats = {'members': 0, 'padded': 0, 'copied_bytes': 0, 'padded_bytes': 0}
+    buffer = bytearray(COPY_BUFFER_SIZE)
+    with zipfile.ZipFile(src_ipa, 'r') as zin, open(src_ipa, 'rb') as src_fp, \
+            zipfile.ZipFile(dst_ipa, 'w') as zout, ThreadPoolExecutor(max_workers) as pool:
+        # (zinfo, future), future 为 None 或结果为 None 表示原样复制, 最多保留 2 * max_workers 个未写出的填充成员
+        pending = deque()
+        running = 0
+
+        def flush(limit):
+            nonlocal running
+            while pending and running > limit:
+                zinfo, future = pending.popleft()
+                new_info = copy.copy(zinfo)
+                padded = None
+                if future is not None:
+                    padded = future.result()
+                    running -= 1
+                if padded is None:
+                    offset = raw_data_offset(src_fp, zinfo)
+                    write_member(zout, new_info,
+                                 lambda: copy_raw(src_fp, zout.fp, offset, zinfo.compress_size, buffer))
+                    stats['copied_bytes'] += zinfo.compress_size
+                    continue
+                output, new_info.CRC, new_info.file_size, new_info.compress_size = padded
+                with output:
+                    write_member(zout, new_info, lambda: shutil.copyfileobj(output, zout.fp, COPY_BUFFER_SIZE))
+                stats['padded'] += 1
+                stats['padded_bytes'] += new_info.file_size - zinfo.file_size
+                count("padded_members")
+
+        with stage("repack", ipa=os.path.basename(src_ipa)):
+            for zinfo in zin.infolist():
+                stats['members'] += 1
+                if (zinfo.filename.startswith(prefix) and not zinfo.is_dir() and should_pad(zinfo.filename)
+                        and not zinfo.flag_bits & FLAG_ENCRYPTED
+                        and zinfo.compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED)):
+                    pending.append((zinfo, pool.submit(pad_member, zin, zinfo, padding_size(rng), level)))
+                    running += 1
+                else:
+                    pending.append((zinfo, None))
+                flush(2 * max_workers)
+            flush(-1)
+            # 成员是直接写入 zout.fp 的, 按 ZipFile 内部的写法设置 central directory 的位置并标记已修改,
+            # close() 时才会写出 central directory 和 end record.
+            # 依赖 CPython zipfile 的内部属性(filelist, NameToInfo, start_dir, _didModify), 已在 CPython 3.6 - 3.13
+            # 上检查输出可以被 zipfile 和 unzip -t 正确读取
+            zout.start_dir = zout.fp.tell()
+            zout._didModify = True
+    return stats
+
+
+def usage():
+    print("Use:python3 insertZero.py -d payload_dir")
+    print("    python3 insertZero.py -i origin.ipa -o padded.ipa [--prefix Payload/] [--seed 1] [-j 8]")
+
+
+if __name__ == "__main__":
+    enable_from_env()
+    try:
+        opts_list, _ = getopt.getopt(sys.argv[1:], "hd:i:o:j:", ["help", "dir=", "ipa=", "output=", "prefix=",
+                                                                 "seed=", "jobs="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    payload_dir = None
+    ipa_path = None
+    output_path = None
+    member_prefix = 'Payload/'
+    random_seed = None
+    jobs = None
+    for o, a in opts_list:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(1)
+        if o in ("-d", "--dir"):
+            payload_dir = a
+        if o in ("-i", "--ipa"):
+            ipa_path = a
+        if o in ("-o", "--output"):
+            output_path = a
+        if o == "--prefix":
+            member_prefix = a
+        if o == "--seed":
+            random_seed = int(a)
+        if o in ("-j", "--jobs"):
+            jobs = int(a)
 
-process_nib("./callery/res2")
+    if payload_dir:
+        process_nib(payload_dir)
+    elif ipa_path and output_path:
+        result = repack_ipa(ipa_path, output_path, member_prefix, random_seed, jobs)
+        print("成员 %d 个, 填充 %d 个(共 %d 字节), 原样复制 %.1f MB" % (
+            result['members'], result['padded'], result['padded_bytes'], result['copied_bytes'] / 1048576))
+    else:
+        usage()
+        sys.exit(1)
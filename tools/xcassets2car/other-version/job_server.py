@@ -0,0 +1,600 @@
+"""
+常驻的比较/Assets 任务服务, 避免每个任务都重新启动解释器, 导入依赖, 解压和解析
+
+1.监听 Unix socket(默认) 或 localhost TCP 端口, 协议是 JSON lines, 每行一个请求, 一个连接上可以同时提交多个任务
+2.任务在固定数量的工作进程中运行, 超过进程数的任务排队等待
+3.每个工作进程缓存最近用到的原始 ipa 解压目录(二进制解析结果由 compare.init_macho_info 缓存)和解码后的图标,
+  相同原始 ipa / 清单 / 目录的任务优先调度到同一个工作进程, 这个进程忙时才交给其他空闲进程
+4.任务的输出和进度通过 Manager 队列实时返回, 结果也通过同一个队列在所有进度之后返回
+
+请求:
+    {"id": "1", "type": "compare", "origin": "a.ipa", "obfuscated": "b.ipa", "exclude_address": true,
+     "similarity": false}
+    {"id": "2", "type": "assets", "action": "icons", "manifest": "icons.json"}
+    {"id": "3", "type": "assets", "action": "complete" | "dedupe" | "optimize", "dir": "Assets.xcassets"}
+    {"id": "4", "type": "assets", "action": "build", "dst_dir": "out", "source_dir": "images", "icon": "Icon.png"}
+    {"type": "ping"}
+响应(每个任务多行):
+    {"id": "1", "event": "queued"} {"id": "1", "event": "started"} {"id": "1", "event": "progress", "message": "..."}
+    {"id": "1", "event": "result", "result": {...}, "seconds": 1.2} 或 {"id": "1", "event": "error", "error": "..."}
+
+Use:python3 job_server.py [--socket /tmp/xcassets2car.sock | --port 8765] [-j 4]
+    python3 job_server.py --submit '{"type": "compare", "origin": "a.ipa", "obfuscated": "b.ipa"}' [--socket ...]
+"""
+
+import asyncio
+import contextlib
+import getopt
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from pipeline_trace import stage, enable_from_env
+
+DEFAULT_SOCKET_PATH = '/tmp/xcassets2car.sock'
+# 每个工作进程缓存的原始 ipa 解压目录和图标源文件数量
+BASELINE_CACHE_SIZE = 4
+ICON_CACHE_SIZE = 32
+# 请求一行的最大长度
+MAX_REQUEST_SIZE = 1024 * 1024
+ASSETS_ACTIONS = ('icons', 'build', 'complete', 'dedupe', 'optimize')
+
+
+class LruCache:
+    """
+    按最近使用淘汰的缓存, 淘汰时调用 on_evict 清理(例如删除解压目录)
+    """
+
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create):
+        """
+        取出缓存, 没有时用 create() 生成
+        :param key:
+        :param create: 生成值的函数
+        :return:
+        """
+        if key in self.items:
+            self.items.move_to_end(key)
+            self.hits += 1
+            return self.items[key]
+        self.misses += 1
+        value = create()
+        self.items[key] = value
+        while len(self.items) > self.max_size:
+            _key, old = self.items.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(old)
+        return value
+
+    def clear(self):
+        while self.items:
+            _key, old = self.items.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(old)
+
+
+BASELINE_CACHE = LruCache(BASELINE_CACHE_SIZE, lambda path: shutil.rmtree(path, ignore_errors=True))
+ICON_CACHE = LruCache(ICON_CACHE_SIZE)
+
+
+def file_key(path):
+    """
+    文件内容变化后缓存失效
+    :param path:
+    :return: (绝对路径, 修改时间, 大小)
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+class ProgressText:
+    """
+    MachOComparer 的输出和重定向的标准输出按行发送到进度队列
+    """
+
+    def __init__(self, job_id, progress):
+        self.job_id = job_id
+        self.progress = progress
+        self.lines = list()
+        self.pending = ''
+
+    def insert(self, _index, chars, *_tags):
+        self.pending += chars
+        while '\n' in self.pending:
+            line, self.pending = self.pending.split('\n', 1)
+            self.lines.append(line)
+            self.progress.put((self.job_id, 'progress', line))
+
+    def write(self, chars):
+        self.insert(None, chars)
+        return len(chars)
+
+    def delete(self, *_args):
+        pass
+
+    def tag_config(self, *_args, **_kwargs):
+        pass
+
+    def flush(self):
+        if self.pending:
+            self.insert(None, '\n')
+
+
+def init_worker():
+    """
+    工作进程启动时导入依赖, 退出时清理缓存的解压目录
+    :return:
+    """
+    from multiprocessing.util import Finalize
+
+    for module in ('compare', 'Assets', 'numpy', 'macholib.MachO'):
+        importlib.import_module(module)
+    Finalize(None, BASELINE_CACHE.clear, exitpriority=10)
+
+
+def run_compare_job(job_id, params, progress):
+    """
+    在工作进程中比较两个 ipa, 原始 ipa 的解压目录会被缓存
+    :param job_id:
+    :param params: 请求
+    :param progress: 进度队列
+    :return: 结果
+    """
+    import compare
+
+    origin = params['origin']
+    obfuscated = params['obfuscated']
+    for path in (origin, obfuscated):
+        if not os.path.isfile(path):
+            raise ValueError('文件不存在: %s' % path)
+    text = ProgressText(job_id, progress)
+    comparer = compare.MachOComparer(text, params.get('exclude_address', True), params.get('similarity', False))
+    path1 = BASELINE_CACHE.get(file_key(origin), lambda: compare.decompression(origin))
+    path2 = compare.decompression(obfuscated)
+    try:
+        comparer.compare_payloads(path1, path2)
+    finally:
+        shutil.rmtree(path2)
+    text.flush()
+    return {'report': text.lines, 'skipped': [os.path.basename(path) for path in comparer.skipped]}
+
+
+def run_icon_manifest(job_id, params, progress):
+    """
+    按清单生成图标组, 解码和缩放后的图标按源文件缓存
+    :param job_id:
+    :param params: 请求
+    :param progress: 进度队列
+    :return: 汇总
+    """
+    import Assets
+
+    def cache(key, create):
+        source, force = key
+        return ICON_CACHE.get(file_key(source) + (force,), create)
+
+    tasks, errors = Assets.load_app_icon_manifest(params['manifest'])
+    for error in errors:
+        progress.put((job_id, 'progress', error))
+    summary = {'icon_sets': 0, 'written': 0, 'failed': len(errors), 'cached_sources': 0}
+    for task in tasks:
+        result = Assets.render_app_icon_group(task, cache)
+        summary['icon_sets'] += result['icon_sets']
+        summary['written'] += result['written']
+        summary['failed'] += result['failed']
+        summary['cached_sources'] += result['cached']
+        if result['error']:
+            progress.put((job_id, 'progress', '%s: %s' % (result['source'], result['error'])))
+        for error in result['target_errors']:
+            progress.put((job_id, 'progress', error))
+        progress.put((job_id, 'progress', '%s: %d 个图标组' % (result['source'], result['icon_sets'])))
+    return summary
+
+
+def run_build_job(job_id, params, progress):
+    """
+    从图片文件夹生成 Assets.xcassets, 与交互式的 generate_image_assets 相同, 图标有问题时不询问
+    :param job_id:
+    :param params: 请求
+    :param progress: 进度队列
+    :return: 结果
+    """
+    import Assets
+
+    source_dir = params.get('source_dir')
+    icon = params.get('icon')
+    if source_dir and not os.path.isdir(source_dir):
+        raise ValueError('目录不存在: %s' % source_dir)
+    if icon and not os.path.isfile(icon):
+        raise ValueError('文件不存在: %s' % icon)
+    output = ProgressText(job_id, progress)
+    # add_all_dir_images_to_assets 会切换当前目录, 结束后恢复, 不影响同一个工作进程中之后的任务
+    cwd = os.getcwd()
+    try:
+        with contextlib.redirect_stdout(output):
+            assets_dir = Assets.build_image_assets(params['dst_dir'], source_dir, icon, False,
+                                                   params.get('workers', 1))
+    finally:
+        os.chdir(cwd)
+    output.flush()
+    return {'assets_dir': assets_dir, 'image_sets': len(list(Assets.iter_image_sets(assets_dir))),
+            'app_icon': os.path.isdir(os.path.join(assets_dir, 'AppIcon.appiconset'))}
+
+
+def run_assets_job(job_id, params, progress):
+    """
+    在工作进程中运行 Assets 任务
+    :param job_id:
+    :param params: 请求
+    :param progress: 进度队列
+    :return: 结果
+    """
+    import Assets
+
+    action = params.get('action')
+    if action == 'icons':
+        return run_icon_manifest(job_id, params, progress)
+    if action == 'build':
+        return run_build_job(job_id, params, progress)
+    assets_dir = params.get('dir')
+    if not assets_dir or not os.path.isdir(assets_dir):
+        raise ValueError('目录不存在: %s' % assets_dir)
+    # Assets 中的步骤自己也会开进程池, 默认只用 1 个进程, 保证总进程数不超过服务的限制
+    workers = params.get('workers', 1)
+    output = ProgressText(job_id, progress)
+    with contextlib.redirect_stdout(output):
+        if action == 'complete':
+            result = {'rendered': Assets.complete_image_set_renditions(assets_dir, workers)}
+        elif action == 'dedupe':
+            result = Assets.dedupe_image_sets(assets_dir, params.get('similar'), params.get('collapse', False),
+                                              workers)
+        elif action == 'optimize':
+            report = Assets.optimize_image_sets(assets_dir, workers)
+            result = {'before': report['before'], 'after': report['after']}
+        else:
+            raise ValueError('未知的 action: %s' % action)
+    output.flush()
+    return result
+
+
+def run_job(job_id, params, progress):
+    """
+    工作进程的入口
+    队列中的消息为 (任务编号, 事件, 内容), 结果或错误作为最后一条消息放入队列, 保证在所有进度之后到达
+    :param job_id: 服务内部的任务编号
+    :param params: 请求
+    :param progress: 进度队列
+    :return:
+    """
+    progress.put((job_id, 'started', None))
+    try:
+        if params['type'] == 'compare':
+            result = run_compare_job(job_id, params, progress)
+        else:
+            result = run_assets_job(job_id, params, progress)
+    except Exception as e:
+        progress.put((job_id, 'error', '%s: %s' % (type(e).__name__, e)))
+    else:
+        progress.put((job_id, 'result', result))
+
+
+class JobServer:
+    """
+    接收任务, 调度到工作进程, 把进度和结果写回提交任务的连接
+    每个工作进程是一个单进程的 ProcessPoolExecutor, 这样可以按缓存键选择进程
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.manager = multiprocessing.Manager()
+        self.progress = self.manager.Queue()
+        self.workers = [ProcessPoolExecutor(1, initializer=init_worker) for _ in range(self.max_workers)]
+        self.idle = set(range(self.max_workers))
+        self.idle_changed = None
+        self.job_ids = itertools.count(1)
+        # 任务编号 -> 发送函数
+        self.senders = dict()
+        # 任务编号 -> 等待结果的 Future, 结果为 (事件, 内容)
+        self.results = dict()
+        # 已经在工作进程中开始的任务编号
+        self.started = set()
+        self.loop = None
+
+    async def acquire_worker(self, affinity):
+        """
+        等待空闲的工作进程, 优先选择 affinity 对应的进程
+        :param affinity: 缓存键, 例如原始 ipa 路径
+        :return: 工作进程下标
+        """
+        preferred = zlib.crc32(affinity.encode('utf-8')) % self.max_workers
+        async with self.idle_changed:
+            await self.idle_changed.wait_for(lambda: self.idle)
+            worker = preferred if preferred in self.idle else min(self.idle)
+            self.idle.remove(worker)
+            return worker
+
+    def replace_worker(self, worker):
+        """
+        工作进程异常退出(内存不足, 原生库崩溃)后进程池不能再用, 换成新的进程池
+        新进程的缓存是空的, 按缓存键调度到这里的任务会重新解压和解析
+        :param worker: 工作进程下标
+        :return:
+        """
+        broken = self.workers[worker]
+        self.workers[worker] = ProcessPoolExecutor(1, initializer=init_worker)
+        broken.shutdown(wait=False)
+
+    async def release_worker(self, worker):
+        async with self.idle_changed:
+            self.idle.add(worker)
+            self.idle_changed.notify()
+
+    def pump_progress(self):
+        """
+        在后台线程中读取进度队列, 转交给事件循环
+        :return:
+        """
+        while True:
+            item = self.progress.get()
+            if item is None:
+                return
+            self.loop.call_soon_threadsafe(self.dispatch_progress, *item)
+
+    def dispatch_progress(self, job_id, event, content):
+        sender = self.senders.get(job_id)
+        if sender is None:
+            return
+        if event == 'started':
+            self.started.add(job_id)
+            sender({'event': 'started'})
+        elif event == 'progress':
+            sender({'event': 'progress', 'message': content})
+        else:
+            self.results[job_id].set_result((event, content))
+
+    async def handle_client(self, reader, writer):
+        """
+        处理一个连接, 每行一个请求, 任务并发执行
+        :param reader:
+        :param writer:
+        :return:
+        """
+        tasks = set()
+
+        def send(message):
+            if not writer.is_closing():
+                writer.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('请求必须是 JSON object')
+                except ValueError as e:
+                    send({'event': 'error', 'error': '请求格式错误: %s' % e})
+                    continue
+                if request.get('type') == 'ping':
+                    send({'id': request.get('id'), 'event': 'pong', 'running': len(self.started),
+                          'queued': len(self.senders) - len(self.started), 'workers': self.max_workers})
+                    continue
+                task = asyncio.ensure_future(self.run_request(request, send))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run_request(self, request, send):
+        """
+        检查请求, 提交到进程池, 返回结果
+        :param request:
+        :param send: 发送函数
+        :return:
+        """
+        request_id = request.get('id')
+
+        def reply(message):
+            message['id'] = request_id
+            send(message)
+
+        error = validate_request(request)
+        if error:
+            reply({'event': 'error', 'error': error})
+            return
+        job_id = next(self.job_ids)
+        self.senders[job_id] = reply
+        self.results[job_id] = self.loop.create_future()
+        reply({'event': 'queued'})
+        start = time.perf_counter()
+        try:
+            worker = await self.acquire_worker(request_affinity(request))
+            try:
+                with stage("job", type=request['type']):
+                    await self.loop.run_in_executor(self.workers[worker], run_job, job_id, request, self.progress)
+            except BrokenProcessPool:
+                self.replace_worker(worker)
+                reply({'event': 'error', 'error': '工作进程异常退出, 已重新启动'})
+                return
+            finally:
+                await self.release_worker(worker)
+            # run_job 返回前结果已经放入队列, 等后台线程转交过来, 之前的进度都已经发出
+            event, content = await self.results[job_id]
+            if event == 'result':
+                reply({'event': 'result', 'result': content, 'seconds': time.perf_counter() - start})
+            else:
+                reply({'event': 'error', 'error': content})
+        except Exception as e:
+            reply({'event': 'error', 'error': '%s: %s' % (type(e).__name__, e)})
+        finally:
+            del self.senders[job_id]
+            del self.results[job_id]
+            self.started.discard(job_id)
+
+    async def serve(self, socket_path=None, port=None):
+        """
+        开始服务, 直到进程被中断
+        :param socket_path: Unix socket 路径
+        :param port: 使用 localhost TCP 端口代替 Unix socket
+        :return:
+        """
+        self.loop = asyncio.get_running_loop()
+        self.idle_changed = asyncio.Condition()
+        pump = threading.Thread(target=self.pump_progress, daemon=True)
+        pump.start()
+        # 预先启动所有工作进程, 第一个任务不用等待导入依赖
+        await asyncio.gather(*(self.loop.run_in_executor(worker, os.getpid) for worker in self.workers))
+        if port is not None:
+            server = await asyncio.start_server(self.handle_client, '127.0.0.1', port, limit=MAX_REQUEST_SIZE)
+            print('监听 127.0.0.1:%d, %d 个工作进程' % (port, self.max_workers))
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle_client, socket_path, limit=MAX_REQUEST_SIZE)
+            print('监听 %s, %d 个工作进程' % (socket_path, self.max_workers))
+        # 后台运行时 SIGINT 可能被忽略, SIGINT 和 SIGTERM 都正常退出并清理 socket
+        stop = asyncio.Event()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signal_number, stop.set)
+        try:
+            async with server:
+                await stop.wait()
+        finally:
+            self.progress.put(None)
+            for worker in self.workers:
+                worker.shutdown()
+            self.manager.shutdown()
+            if port is None and os.path.exists(socket_path):
+                os.remove(socket_path)
+
+
+def request_affinity(request):
+    """
+    任务的缓存键, 相同的键尽量在同一个工作进程中运行
+    :param request:
+    :return:
+    """
+    if request['type'] == 'compare':
+        return os.path.abspath(request['origin'])
+    return os.path.abspath(request.get('manifest') or request.get('dir') or request.get('dst_dir'))
+
+
+def validate_request(request):
+    """
+    在提交到进程池之前检查请求
+    :param request:
+    :return: 错误信息, 没有错误时为 None
+    """
+    job_type = request.get('type')
+    if job_type == 'compare':
+        if not request.get('origin') or not request.get('obfuscated'):
+            return 'compare 需要 origin 和 obfuscated'
+        return None
+    if job_type == 'assets':
+        action = request.get('action')
+        if action not in ASSETS_ACTIONS:
+            return 'assets 的 action 必须是 %s 之一' % ', '.join(ASSETS_ACTIONS)
+        if action == 'icons' and not request.get('manifest'):
+            return 'icons 需要 manifest'
+        if action == 'build' and not request.get('dst_dir'):
+            return 'build 需要 dst_dir'
+        if action not in ('icons', 'build') and not request.get('dir'):
+            return '%s 需要 dir' % action
+        return None
+    return '未知的任务类型: %s' % job_type
+
+
+def submit_job(request, socket_path=DEFAULT_SOCKET_PATH, port=None):
+    """
+    提交一个任务并逐行返回响应, 直到结果或错误
+    :param request: 请求 dict
+    :param socket_path: Unix socket 路径
+    :param port: localhost TCP 端口
+    :return: 生成响应 dict
+    """
+    if port is not None:
+        sock = socket.create_connection(('127.0.0.1', port))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    with sock, sock.makefile('rb') as f:
+        sock.sendall(json.dumps(request, ensure_ascii=False).encode('utf-8') + b'\n')
+        for line in f:
+            message = json.loads(line)
+            yield message
+            if message['event'] in ('result', 'error', 'pong'):
+                return
+
+
+def usage():
+    print("Use:python3 job_server.py [--socket /tmp/xcassets2car.sock | --port 8765] [-j 4]  启动服务")
+    print("    python3 job_server.py --submit '{\"type\": \"compare\", \"origin\": \"a.ipa\", \"obfuscated\": \"b.ipa\"}'"
+          "  提交任务")
+    print("环境变量 PIPELINE_TRACE=trace.json 统计各阶段耗时")
+
+
+if __name__ == "__main__":
+    try:
+        opts_list, _ = getopt.getopt(sys.argv[1:], "hj:", ["help", "socket=", "port=", "jobs=", "submit="])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    server_socket = DEFAULT_SOCKET_PATH
+    server_port = None
+    jobs = None
+    submit = None
+    for o, a in opts_list:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(1)
+        if o == "--socket":
+            server_socket = a
+        if o == "--port":
+            server_port = int(a)
+        if o in ("-j", "--jobs"):
+            jobs = int(a)
+        if o == "--submit":
+            submit = a
+
+    if submit is not None:
+        exit_code = 0
+        for response in submit_job(json.loads(submit), server_socket, server_port):
+            if response['event'] == 'progress':
+                print(response['message'])
+            else:
+                print(json.dumps(response, ensure_ascii=False))
+            if response['event'] == 'error':
+                exit_code = 1
+        sys.exit(exit_code)
+
+    enable_from_env()
+    try:
+        asyncio.run(JobServer(jobs).serve(server_socket, server_port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,531 @@
+"""
+生成用于测试和性能测试 compare.py 的 Mach-O / ipa
+
+不需要真实的 ipa, 也不需要 macOS:
+1.build_binary_pair 同时写出一对 arm64 Mach-O(原始/混淆), 可选 fat(armv7 + arm64)
+    1)__text 大小可配置, 按块流式生成, 1GB 也不会占用大量内存
+    2)__cstring, __objc_classname, __objc_methname, __objc_methtype 的字符串数量和符号表数量可配置
+      __DATA 中有最小的 objc 元数据(每个类名一个类, 方法名轮流分给各个类, 每个方法名一个 selector 引用),
+      __LINKEDIT 中有 LC_DYLD_EXPORTS_TRIE 导出表
+    3)混淆比例可配置, 返回值中记录了精确的变更数, 用来检查比较结果是否准确
+    4)可以模拟 App Store 下载的加密二进制(cryptid=1, __TEXT 内容为随机数据)
+2.build_ipa_pair 把一对二进制和库二进制, 大量资源文件打包成两个 ipa
+
+Use:python3 macho_fixture.py -o /tmp/fixture --text-size 100 [--fat]
+"""
+
+import getopt
+import os
+import random
+import shutil
+import string
+import struct
+import sys
+import zipfile
+
+try:
+    import numpy as np
+except ImportError:
+    print('pip3 install numpy')
+    sys.exit()
+
+
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+MH_EXECUTE = 0x2
+CPU_TYPE_ARM = 12
+CPU_SUBTYPE_ARM_V7 = 9
+CPU_TYPE_ARM64 = 0x0100000c
+LC_SEGMENT = 0x1
+LC_SEGMENT_64 = 0x19
+LC_SYMTAB = 0x2
+LC_ENCRYPTION_INFO_64 = 0x2c
+LC_DYLD_EXPORTS_TRIE = 0x80000033
+PAGE_SIZE = 0x4000
+VM_BASE = 0x100000000
+# 流式生成 __text 时每块的指令数
+TEXT_CHUNK_WORDS = 4 * 1024 * 1024
+# 常见 arm64 指令去掉寄存器和立即数字段后的编码, 按不均匀的频率组合, 字节熵接近真实机器码(约 6 bits)
+INSN_TEMPLATES = (0xF9400000, 0xF9000000, 0xAA0003E0, 0x91000000, 0x94000000, 0x52800000, 0xB9400000, 0xB4000000,
+                  0x910003FD, 0xA9BF7BFD, 0xA8C17BFD, 0xD65F03C0, 0x90000000, 0xF100001F, 0x54000000, 0x2A0003E0,
+                  0x8B000000, 0x94000000, 0x12000000, 0x39400000)
+# 常用寄存器, 越靠前越常用
+REGISTERS = (0, 1, 2, 8, 19, 20, 21, 22, 29, 30, 31, 3, 9, 10)
+TEXT_SECTIONS = (b'__text', b'__cstring', b'__objc_classname', b'__objc_methname', b'__objc_methtype')
+STRING_SECTIONS = TEXT_SECTIONS[1:]
+DATA_SECTIONS = (b'__objc_classlist', b'__objc_selrefs', b'__objc_const', b'__objc_data')
+# class_t, class_ro_t, method_t 和 method_list_t 头部的长度
+CLASS_SIZE = 40
+CLASS_RO_SIZE = 72
+METHOD_SIZE = 24
+METHOD_LIST_HEADER_SIZE = 8
+INFO_PLIST = b'<?xml version="1.0" encoding="UTF-8"?>\n<plist version="1.0"><dict></dict></plist>\n'
+
+
+def align(value, alignment=PAGE_SIZE):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def random_names(rng, total, min_length=8, max_length=24):
+    """
+    生成不重复的随机标识符
+    :param rng: random.Random
+    :param total: 数量
+    :return: bytes 列表
+    """
+    names = set()
+    letters = string.ascii_letters + string.digits
+    while len(names) < total:
+        length = rng.randint(min_length, max_length)
+        names.add(rng.choice(string.ascii_letters) + ''.join(rng.choice(letters) for _ in range(length - 1)))
+    return [name.encode() for name in sorted(names)]
+
+
+def mutate_names(rng, names, rate):
+    """
+    按比例把名字替换成同长度的随机名字, 保持节的长度和顺序不变
+    :param rng: random.Random
+    :param names: 原始名字
+    :param rate: 替换比例
+    :return: 新名字列表, 替换的数量
+    """
+    letters = string.ascii_letters + string.digits
+    result = list()
+    changed = 0
+    for name in names:
+        if rng.random() < rate:
+            new_name = name
+            while new_name == name:
+                new_name = (rng.choice(string.ascii_letters) +
+                            ''.join(rng.choice(letters) for _ in range(len(name) - 1))).encode()
+            result.append(new_name)
+            changed += 1
+        else:
+            result.append(name)
+    return result, changed
+
+
+def generate_text_chunk(rng, words, mutation_rate, address_rate):
+    """
+    生成一块随机指令和它的混淆版本
+    指令由 INSN_TEMPLATES 加上寄存器和较小的立即数组成
+    地址变更: 两边都是 ADRP, 只有页地址立即数不同
+    混淆变更: 翻转 bit 26(op0 的一位)并改变寄存器字段, 保证不会被当作地址变更
+    :param rng: numpy Generator
+    :param words: 指令数
+    :param mutation_rate: 混淆比例
+    :param address_rate: 地址变更比例
+    :return: 原始指令, 混淆指令, 混淆变更数, 地址变更数
+    """
+    templates = np.array(INSN_TEMPLATES, dtype=np.uint32)
+    template_weights = np.linspace(1, 0.05, len(templates)) ** 2
+    registers = np.array(REGISTERS, dtype=np.uint32)
+    register_weights = 1 / np.arange(1, len(registers) + 1)
+    original = templates[rng.choice(len(templates), words, p=template_weights / template_weights.sum())]
+    for shift in (0, 5):
+        original |= registers[rng.choice(len(registers), words, p=register_weights / register_weights.sum())] << shift
+    original |= (rng.geometric(0.05, words).astype(np.uint32) & np.uint32(0xFFF)) << np.uint32(10)
+    roll = rng.random(words)
+    address_mask = roll < address_rate
+    mutation_mask = (roll >= address_rate) & (roll < address_rate + mutation_rate)
+    original[address_mask] = (original[address_mask] & np.uint32(0x60FFFFFF)) | np.uint32(0x90000000)
+    obfuscated = original.copy()
+    immhi_bits = (np.uint32(1) << (rng.integers(5, 24, size=int(address_mask.sum()), dtype=np.uint32)))
+    obfuscated[address_mask] ^= immhi_bits
+    noise = rng.integers(0, 1 << 10, size=int(mutation_mask.sum()), dtype=np.uint32)
+    obfuscated[mutation_mask] ^= np.uint32(0x04000000) | noise
+    return original, obfuscated, int(mutation_mask.sum()), int(address_mask.sum())
+
+
+def macho_layout(text_size, sections, symbols, classes, methods, export_size):
+    """
+    计算 arm64 切片中各部分的偏移, 偏移相对切片开头
+    :param text_size: __text 长度
+    :param sections: {节名: 内容} 字符串节
+    :param symbols: 符号名列表
+    :param classes: objc 类的数量
+    :param methods: selector 引用的数量, 有类时也是方法的总数
+    :param export_size: 导出表的长度
+    :return: dict
+    """
+    layout = dict()
+    offset = PAGE_SIZE
+    layout[b'__text'] = (offset, text_size)
+    offset += text_size
+    for name in STRING_SECTIONS:
+        layout[name] = (offset, len(sections[name]))
+        offset += len(sections[name])
+    layout['text_segment_size'] = align(offset)
+    data_sizes = {
+        b'__objc_classlist': 8 * classes,
+        b'__objc_selrefs': 8 * methods,
+        b'__objc_const': (CLASS_RO_SIZE + METHOD_LIST_HEADER_SIZE) * classes + (METHOD_SIZE * methods if classes else 0),
+        b'__objc_data': CLASS_SIZE * classes,
+    }
+    offset = layout['text_segment_size']
+    for name in DATA_SECTIONS:
+        layout[name] = (offset, data_sizes[name])
+        offset += data_sizes[name]
+    layout['data_segment_size'] = align(offset - layout['text_segment_size'])
+    layout['symoff'] = layout['text_segment_size'] + layout['data_segment_size']
+    layout['stroff'] = layout['symoff'] + 16 * len(symbols)
+    layout['strsize'] = 1 + sum(len(name) + 1 for name in symbols)
+    layout['export_off'] = align(layout['stroff'] + layout['strsize'], 8)
+    layout['size'] = layout['export_off'] + export_size
+    return layout
+
+
+def macho_header(layout, nsyms, export_size, encrypted=False):
+    """
+    生成 arm64 切片的头部和 load commands
+    :param layout: macho_layout 的结果
+    :param nsyms: 符号数量
+    :param export_size: 这个二进制导出表的实际长度, 不超过 layout 中预留的长度
+    :param encrypted: 是否添加 cryptid=1 的 LC_ENCRYPTION_INFO_64, 加密范围是 __TEXT 中第一页之后的部分
+    :return: bytes
+    """
+    commands = list()
+    commands.append(struct.pack('<II16sQQQQiiII', LC_SEGMENT_64, 72, b'__PAGEZERO', 0, VM_BASE, 0, 0, 0, 0, 0, 0))
+    text = struct.pack('<II16sQQQQiiII', LC_SEGMENT_64, 72 + 80 * len(TEXT_SECTIONS), b'__TEXT', VM_BASE,
+                       layout['text_segment_size'], 0, layout['text_segment_size'], 5, 5, len(TEXT_SECTIONS), 0)
+    for name in TEXT_SECTIONS:
+        offset, size = layout[name]
+        flags = 0x80000400 if name == b'__text' else 0x2
+        text += struct.pack('<16s16sQQIIIIIIII', name, b'__TEXT', VM_BASE + offset, size, offset,
+                            2 if name == b'__text' else 0, 0, 0, flags, 0, 0, 0)
+    commands.append(text)
+    data = struct.pack('<II16sQQQQiiII', LC_SEGMENT_64, 72 + 80 * len(DATA_SECTIONS), b'__DATA',
+                       VM_BASE + layout['text_segment_size'], layout['data_segment_size'], layout['text_segment_size'],
+                       layout['data_segment_size'], 3, 3, len(DATA_SECTIONS), 0)
+    for name in DATA_SECTIONS:
+        offset, size = layout[name]
+        data += struct.pack('<16s16sQQIIIIIIII', name, b'__DATA', VM_BASE + offset, size, offset, 3, 0, 0, 0, 0, 0, 0)
+    commands.append(data)
+    linkedit_size = layout['size'] - layout['symoff']
+    commands.append(struct.pack('<II16sQQQQiiII', LC_SEGMENT_64, 72, b'__LINKEDIT',
+                                VM_BASE + layout['symoff'], align(linkedit_size),
+                                layout['symoff'], linkedit_size, 1, 1, 0, 0))
+    commands.append(struct.pack('<IIIIII', LC_SYMTAB, 24, layout['symoff'], nsyms, layout['stroff'], layout['strsize']))
+    commands.append(struct.pack('<IIII', LC_DYLD_EXPORTS_TRIE, 16, layout['export_off'], export_size))
+    if encrypted:
+        commands.append(struct.pack('<IIIIII', LC_ENCRYPTION_INFO_64, 24, PAGE_SIZE,
+                                    layout['text_segment_size'] - PAGE_SIZE, 1, 0))
+    body = b''.join(commands)
+    return struct.pack('<IiiIIIII', MH_MAGIC_64, CPU_TYPE_ARM64, 0, MH_EXECUTE, len(commands), len(body), 0, 0) + body
+
+
+def armv7_slice():
+    """
+    fat 文件中的 armv7 切片, 只有一个很小的 __text
+    :return: bytes
+    """
+    text = b'\x00\xbf' * 8
+    section = struct.pack('<16s16sIIIIIIIII', b'__text', b'__TEXT', 0x4000 + 0x1000, len(text), 0x1000,
+                          1, 0, 0, 0x80000400, 0, 0)
+    segment = struct.pack('<II16sIIIIiiII', LC_SEGMENT, 56 + 68, b'__TEXT', 0x4000, 0x2000, 0, 0x2000,
+                          5, 5, 1, 0) + section
+    header = struct.pack('<IiiIIII', MH_MAGIC, CPU_TYPE_ARM, CPU_SUBTYPE_ARM_V7, MH_EXECUTE, 1, len(segment), 0)
+    return (header + segment).ljust(0x1000, b'\x00') + text
+
+
+def symbol_table(symbols):
+    """
+    生成 nlist_64 数组和字符串表
+    :param symbols: 符号名列表
+    :return: bytes
+    """
+    entries = list()
+    strtab = [b'\x00']
+    strx = 1
+    for index, name in enumerate(symbols):
+        entries.append(struct.pack('<IBBHQ', strx, 0x0f, 1, 0, VM_BASE + PAGE_SIZE + index * 4))
+        strtab.append(name + b'\x00')
+        strx += len(name) + 1
+    return b''.join(entries) + b''.join(strtab)
+
+
+def string_addresses(layout, name, names):
+    """
+    字符串节中每个字符串的虚拟地址
+    :param layout: macho_layout 的结果
+    :param name: 节名
+    :param names: 节中的字符串列表
+    :return: 地址列表
+    """
+    result = list()
+    addr = VM_BASE + layout[name][0]
+    for item in names:
+        result.append(addr)
+        addr += len(item) + 1
+    return result
+
+
+def objc_metadata(layout, classnames, methnames):
+    """
+    生成 __DATA 中的 objc 元数据, 没有 chained fixups, 指针直接写虚拟地址
+    每个类名对应一个类(没有元类), 方法名按顺序轮流分给各个类, 每个方法名有一个 selector 引用.
+    原始和混淆二进制中名字的长度相同, 元数据也完全相同
+    :param layout: macho_layout 的结果
+    :param classnames: __objc_classname 中的类名
+    :param methnames: __objc_methname 中的方法名
+    :return: {节名: 内容}
+    """
+    class_addrs = string_addresses(layout, b'__objc_classname', classnames)
+    meth_addrs = string_addresses(layout, b'__objc_methname', methnames)
+    classes = len(class_addrs)
+    ro_addr = VM_BASE + layout[b'__objc_const'][0]
+    list_addr = ro_addr + CLASS_RO_SIZE * classes
+    class_addr = VM_BASE + layout[b'__objc_data'][0]
+    ro_list = list()
+    method_lists = list()
+    class_list = list()
+    for index, name_addr in enumerate(class_addrs):
+        methods = meth_addrs[index::classes]
+        ro_list.append(struct.pack('<IIII7Q', 0, 0, 0, 0, 0, name_addr, list_addr, 0, 0, 0, 0))
+        method_lists.append(struct.pack('<II', METHOD_SIZE, len(methods)))
+        method_lists.extend(struct.pack('<QQQ', addr, 0, 0) for addr in methods)
+        class_list.append(struct.pack('<5Q', 0, 0, 0, 0, ro_addr + CLASS_RO_SIZE * index))
+        list_addr += METHOD_LIST_HEADER_SIZE + METHOD_SIZE * len(methods)
+    return {
+        b'__objc_classlist': b''.join(struct.pack('<Q', class_addr + CLASS_SIZE * index) for index in range(classes)),
+        b'__objc_selrefs': b''.join(struct.pack('<Q', addr) for addr in meth_addrs),
+        b'__objc_const': b''.join(ro_list + method_lists),
+        b'__objc_data': b''.join(class_list),
+    }
+
+
+def uleb128(value):
+    result = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if not value:
+            result.append(byte)
+            return bytes(result)
+        result.append(byte | 0x80)
+
+
+def export_trie(names):
+    """
+    生成导出符号 trie, 每条边只有一个字符, 子节点数不会超过 1 字节的上限
+    子节点的偏移是 ULEB128, 长度取决于偏移本身, 按 ld64 的做法反复计算直到所有偏移不再变化
+    :param names: 导出的符号名, 第 i 个符号的地址与 symbol_table 中的相同
+    :return: bytes
+    """
+    # 节点: [地址或 None, {字符: 子节点}]
+    root = [None, dict()]
+    for index, name in enumerate(names):
+        node = root
+        for char in name:
+            node = node[1].setdefault(bytes([char]), [None, dict()])
+        node[0] = PAGE_SIZE + index * 4
+    nodes = [root]
+    for node in nodes:
+        nodes.extend(child for _char, child in sorted(node[1].items()))
+    indexes = {id(node): index for index, node in enumerate(nodes)}
+    offsets = [0] * len(nodes)
+    while True:
+        blobs = list()
+        for address, children in nodes:
+            terminal = b'' if address is None else uleb128(0) + uleb128(address)
+            blob = uleb128(len(terminal)) + terminal + bytes([len(children)])
+            for char, child in sorted(children.items()):
+                blob += char + b'\x00' + uleb128(offsets[indexes[id(child)]])
+            blobs.append(blob)
+        new_offsets = list()
+        offset = 0
+        for blob in blobs:
+            new_offsets.append(offset)
+            offset += len(blob)
+        if new_offsets == offsets:
+            return b''.join(blobs)
+        offsets = new_offsets
+
+
+def build_binary_pair(path1, path2, text_size=16 * 1024 * 1024, cstrings=10000, classnames=1000, methnames=10000,
+                      methtypes=500, symbols=10000, exports=1000, text_mutation=0.5, string_mutation=0.5,
+                      address_rate=0.0, fat=False, encrypted=False, seed=0):
+    """
+    同时生成原始和混淆两个二进制
+    :param path1: 原始二进制路径
+    :param path2: 混淆二进制路径
+    :param text_size: __text 长度, 向下对齐到 4 字节
+    :param cstrings: __cstring 字符串数量
+    :param classnames: __objc_classname 字符串数量
+    :param methnames: __objc_methname 字符串数量
+    :param methtypes: __objc_methtype 字符串数量
+    :param symbols: 符号表数量
+    :param exports: 导出表数量, 导出符号表中的前 exports 个符号
+    :param text_mutation: 指令混淆比例
+    :param string_mutation: 字符串和符号混淆比例
+    :param address_rate: 只有 ADRP 页地址变化的指令比例
+    :param fat: 是否生成 armv7 + arm64 的 fat 文件
+    :param encrypted: 原始二进制是否模拟 FairPlay 加密, 原始二进制中 __text 和字符串节写入随机数据
+    :param seed: 随机种子, 相同参数和种子生成相同的文件
+    :return: 精确的变更数量, 用来检查比较结果
+    """
+    text_size -= text_size % 4
+    rng = random.Random(seed)
+    counts = {b'__cstring': cstrings, b'__objc_classname': classnames,
+              b'__objc_methname': methnames, b'__objc_methtype': methtypes}
+    sections1 = dict()
+    sections2 = dict()
+    strings = dict()
+    expected = {'text_words': text_size // 4, 'text_changed': 0, 'address_only': 0}
+    for name in STRING_SECTIONS:
+        names = random_names(rng, counts[name])
+        new_names, changed = mutate_names(rng, names, string_mutation)
+        strings[name] = names
+        sections1[name] = b''.join(item + b'\x00' for item in names)
+        sections2[name] = b''.join(item + b'\x00' for item in new_names)
+        expected[name.decode().lstrip('_')] = changed
+    symbol_names = [b'_' + name for name in random_names(rng, symbols)]
+    new_symbol_names, expected['symbols_changed'] = mutate_names(rng, symbol_names, string_mutation)
+    expected['symbols'] = len(symbol_names)
+    # 每个方法名都有 selector 引用, 有类时每个方法名也都属于一个类
+    expected['objc_classes'] = classnames
+    expected['objc_classes_changed'] = expected['objc_classname']
+    expected['objc_methods'] = methnames if classnames else 0
+    expected['objc_methods_changed'] = expected['objc_methname'] if classnames else 0
+    expected['objc_selrefs'] = methnames
+    expected['objc_selrefs_changed'] = expected['objc_methname']
+    tries = (export_trie(symbol_names[:exports]), export_trie(new_symbol_names[:exports]))
+    expected['exports'] = len(symbol_names[:exports])
+    expected['exports_changed'] = sum(name != new_name for name, new_name in
+                                      zip(symbol_names[:exports], new_symbol_names[:exports]))
+
+    layout = macho_layout(text_size, sections1, symbol_names, classnames, methnames, max(map(len, tries)))
+    base = 0
+    prefix = b''
+    if fat:
+        arm_slice = armv7_slice()
+        base = align(8 + 20 * 2 + len(arm_slice) + PAGE_SIZE)
+        prefix = struct.pack('>II', FAT_MAGIC, 2)
+        prefix += struct.pack('>iiIII', CPU_TYPE_ARM, CPU_SUBTYPE_ARM_V7, PAGE_SIZE, len(arm_slice), 14)
+        prefix += struct.pack('>iiIII', CPU_TYPE_ARM64, 0, base, layout['size'], 14)
+        prefix = prefix.ljust(PAGE_SIZE, b'\x00') + arm_slice
+    headers = (macho_header(layout, len(symbol_names), len(tries[0]), encrypted),
+               macho_header(layout, len(symbol_names), len(tries[1])))
+    objc = objc_metadata(layout, strings[b'__objc_classname'], strings[b'__objc_methname'])
+
+    text_rng = np.random.default_rng(seed)
+    with open(path1, 'wb') as f1, open(path2, 'wb') as f2:
+        for f, header in zip((f1, f2), headers):
+            f.write(prefix)
+            f.write(b'\x00' * (base - len(prefix)))
+            f.write(header.ljust(PAGE_SIZE, b'\x00'))
+        remaining = text_size // 4
+        while remaining:
+            words = min(remaining, TEXT_CHUNK_WORDS)
+            original, obfuscated, changed, address_only = generate_text_chunk(
+                text_rng, words, text_mutation, address_rate)
+            if encrypted:
+                original = text_rng.integers(0, 1 << 32, words, dtype=np.uint32)
+            f1.write(original.astype('<u4').tobytes())
+            f2.write(obfuscated.astype('<u4').tobytes())
+            expected['text_changed'] += changed
+            expected['address_only'] += address_only
+            remaining -= words
+        for name in STRING_SECTIONS:
+            f1.write(os.urandom(len(sections1[name])) if encrypted else sections1[name])
+            f2.write(sections2[name])
+        for f, names, trie in ((f1, symbol_names, tries[0]), (f2, new_symbol_names, tries[1])):
+            f.seek(base + layout['text_segment_size'])
+            f.write(b''.join(objc[name] for name in DATA_SECTIONS))
+            f.seek(base + layout['symoff'])
+            f.write(symbol_table(names))
+            f.seek(base + layout['export_off'])
+            f.write(trie.ljust(layout['size'] - layout['export_off'], b'\x00'))
+    return expected
+
+
+def build_ipa_pair(ipa_path1, ipa_path2, work_dir, app_name='Fixture', frameworks=2, framework_text_size=1024 * 1024,
+                   resources=200, resource_size=64 * 1024, compression=zipfile.ZIP_DEFLATED, **binary_kwargs):
+    """
+    生成原始和混淆两个 ipa
+    :param ipa_path1: 原始 ipa 路径
+    :param ipa_path2: 混淆 ipa 路径
+    :param work_dir: 临时目录, 存放生成的二进制
+    :param app_name: app 名, 也是主二进制名
+    :param frameworks: 库的数量
+    :param framework_text_size: 每个库的 __text 长度
+    :param resources: 资源文件数量, 两个 ipa 中相同
+    :param resource_size: 每个资源文件的大小
+    :param compression: zip 压缩方式
+    :param binary_kwargs: 传给主二进制的 build_binary_pair 参数
+    :return: {二进制在 ipa 中的路径: build_binary_pair 的结果}
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    app_dir = 'Payload/{}.app/'.format(app_name)
+    seed = binary_kwargs.pop('seed', 0)
+    binaries = [(app_dir + app_name, dict(binary_kwargs, seed=seed))]
+    for index in range(frameworks):
+        name = 'Lib{}'.format(index)
+        binaries.append(('{}Frameworks/{}.framework/{}'.format(app_dir, name, name),
+                         dict(binary_kwargs, text_size=framework_text_size, seed=seed + index + 1)))
+    expected = dict()
+    rng = random.Random(seed)
+    with zipfile.ZipFile(ipa_path1, 'w', compression) as ipa1, zipfile.ZipFile(ipa_path2, 'w', compression) as ipa2:
+        for arcname, kwargs in binaries:
+            path1 = os.path.join(work_dir, 'origin.bin')
+            path2 = os.path.join(work_dir, 'obfuscated.bin')
+            expected[arcname] = build_binary_pair(path1, path2, **kwargs)
+            ipa1.write(path1, arcname)
+            ipa2.write(path2, arcname)
+            os.remove(path1)
+            os.remove(path2)
+        for ipa in (ipa1, ipa2):
+            ipa.writestr(app_dir + 'Info.plist', INFO_PLIST)
+        for index in range(resources):
+            # 一半可压缩, 一半不可压缩, 接近真实 ipa 中图片和配置文件的混合
+            if index % 2:
+                data = (rng.randbytes(256) * (resource_size // 256 + 1))[:resource_size]
+            else:
+                data = os.urandom(resource_size)
+            arcname = '{}res/resource_{}.dat'.format(app_dir, index)
+            ipa1.writestr(arcname, data)
+            ipa2.writestr(arcname, data)
+    return expected
+
+
+def usage():
+    print("Use:python3 macho_fixture.py -o /tmp/fixture [--text-size 100] [--fat] [--frameworks 2] [--encrypted]")
+    print("    --text-size 主二进制 __text 大小(MB), 生成 origin.ipa 和 obfuscated.ipa")
+
+
+if __name__ == "__main__":
+    try:
+        opts_list, _ = getopt.getopt(sys.argv[1:], "ho:", ["help", "output=", "text-size=", "fat", "frameworks=",
+                                                              "encrypted"])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+
+    output_dir = None
+    options = dict()
+    for o, a in opts_list:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(1)
+        if o in ("-o", "--output"):
+            output_dir = a
+        if o == "--text-size":
+            options['text_size'] = int(float(a) * 1024 * 1024)
+        if o == "--fat":
+            options['fat'] = True
+        if o == "--frameworks":
+            options['frameworks'] = int(a)
+        if o == "--encrypted":
+            options['encrypted'] = True
+    if output_dir is None:
+        usage()
+        sys.exit(1)
+
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_dir = os.path.join(output_dir, 'tmp')
+    result = build_ipa_pair(os.path.join(output_dir, 'origin.ipa'), os.path.join(output_dir, 'obfuscated.ipa'),
+                            tmp_dir, **options)
+    shutil.rmtree(tmp_dir)
+    for binary, counts in result.items():
+        print(binary, counts)
@@ -0,0 +1,197 @@
+"""
+Assets.py 和 compare.py 共用的阶段耗时统计
+
+默认关闭, 不影响正常使用, 通过环境变量打开:
+1.PIPELINE_TRACE=trace.json  退出时导出 Chrome trace-event JSON, 可以在 chrome://tracing 或 Perfetto 中打开,
+    同时在终端输出每个阶段的次数, 总耗时和峰值内存
+2.PIPELINE_PROFILE=out.prof  用 cProfile 记录整个过程, 退出时保存并输出耗时最多的函数
+3.PIPELINE_RSS_INTERVAL=0.05 内存采样间隔(秒)
+
+只统计当前进程, 进程池中子进程的耗时体现在主进程包裹它的阶段中, 子进程峰值内存单独输出.
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def current_rss():
+    """
+    当前进程的常驻内存(字节), 没有 /proc 的系统(macOS)用历史峰值代替
+    :return:
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return max_rss()
+
+
+def max_rss(who=None):
+    """
+    getrusage 中的峰值内存(字节), Linux 单位是 KB, macOS 是字节
+    :param who: resource.RUSAGE_SELF 或 resource.RUSAGE_CHILDREN
+    :return:
+    """
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF if who is None else who)
+    return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+
+
+class Tracer:
+    """
+    记录阶段耗时, 计数器和内存采样
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = list()
+        self.stats = dict()
+        self.counters = dict()
+        self.peak_rss = 0
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.trace_path = None
+        self.profile_path = None
+        self.profiler = None
+        self.sampler = None
+        self.sampling = threading.Event()
+
+    def now_us(self):
+        return (time.perf_counter() - self.origin) * 1e6
+
+    @contextmanager
+    def stage(self, name, **args):
+        """
+        统计一个阶段的耗时
+        with stage("copy"):
+            ...
+        :param name: 阶段名
+        :param args: 附加到 trace 事件上的参数
+        :return:
+        """
+        if not self.enabled:
+            yield
+            return
+        start = self.now_us()
+        try:
+            yield
+        finally:
+            duration = self.now_us() - start
+            self.events.append({
+                "name": name, "cat": "stage", "ph": "X", "ts": start, "dur": duration,
+                "pid": self.pid, "tid": threading.get_ident(), "args": args,
+            })
+            stat = self.stats.setdefault(name, [0, 0.0])
+            stat[0] += 1
+            stat[1] += duration
+
+    def count(self, name, value=1):
+        """
+        累加计数器
+        :param name: 计数器名
+        :param value: 增加的值
+        :return:
+        """
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + value
+        self.events.append({
+            "name": name, "ph": "C", "ts": self.now_us(), "pid": self.pid, "args": {name: self.counters[name]},
+        })
+
+    def sample_rss(self, interval):
+        while not self.sampling.wait(interval):
+            self.record_rss()
+
+    def record_rss(self):
+        rss = current_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        self.events.append({
+            "name": "rss", "ph": "C", "ts": self.now_us(), "pid": self.pid, "args": {"MB": rss / 1048576},
+        })
+
+    def start(self, trace_path=None, profile_path=None, rss_interval=0.05):
+        """
+        开始统计
+        :param trace_path: 导出 trace 的路径, None 表示只在终端输出汇总
+        :param profile_path: cProfile 结果路径, None 表示不打开 cProfile
+        :param rss_interval: 内存采样间隔(秒)
+        :return:
+        """
+        if self.enabled:
+            return
+        self.enabled = True
+        self.trace_path = trace_path
+        self.profile_path = profile_path
+        self.events.append({"name": "process_name", "ph": "M", "pid": self.pid,
+                            "args": {"name": os.path.basename(sys.argv[0]) or "python"}})
+        if profile_path:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.sampler = threading.Thread(target=self.sample_rss, args=(rss_interval,), daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        """
+        停止统计, 导出 trace 和 cProfile 结果, 输出汇总
+        :return:
+        """
+        if not self.enabled:
+            return
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.sampling.set()
+        self.sampler.join()
+        self.record_rss()
+        self.enabled = False
+        self.peak_rss = max(self.peak_rss, max_rss())
+        if self.trace_path:
+            with open(self.trace_path, "w") as f:
+                json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+            print("trace 已保存到", self.trace_path)
+        if self.profiler is not None:
+            import pstats
+            self.profiler.dump_stats(self.profile_path)
+            pstats.Stats(self.profiler).sort_stats("cumulative").print_stats(20)
+        self.print_summary()
+
+    def print_summary(self):
+        print("%-32s %8s %12s %12s" % ("阶段", "次数", "总耗时(s)", "平均(ms)"))
+        for name, (calls, total) in sorted(self.stats.items(), key=lambda item: -item[1][1]):
+            print("%-32s %8d %12.3f %12.3f" % (name, calls, total / 1e6, total / calls / 1e3))
+        for name, value in sorted(self.counters.items()):
+            print("%-32s %8d" % (name, value))
+        print("峰值内存: %.1f MB" % (self.peak_rss / 1048576))
+        if resource is not None and max_rss(resource.RUSAGE_CHILDREN):
+            print("子进程峰值内存: %.1f MB" % (max_rss(resource.RUSAGE_CHILDREN) / 1048576))
+
+
+TRACER = Tracer()
+stage = TRACER.stage
+count = TRACER.count
+
+
+def enable_from_env():
+    """
+    根据环境变量打开统计, 并在退出时导出
+    :return: 是否打开
+    """
+    trace_path = os.environ.get("PIPELINE_TRACE")
+    profile_path = os.environ.get("PIPELINE_PROFILE")
+    if not trace_path and not profile_path:
+        return False
+    TRACER.start(trace_path, profile_path, float(os.environ.get("PIPELINE_RSS_INTERVAL", "0.05")))
+    atexit.register(TRACER.stop)
+    return True